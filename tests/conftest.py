@@ -0,0 +1,36 @@
+#shared fixtures of the VIN decoder tests, every test decodes against a local stand-in for the NHTSA vPIC API
+#replaying the example VINs, with the VIN cache, offline decoder and rate limit turned off so each test only sees
+#the requests it sends itself
+
+#import necessary packages
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vin_pipeline
+from vin_mock_server import MockVpicServer
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+
+#options of an upload decoded without the VIN cache or the offline decoder
+OPTIONS = {'use_cache': False, 'use_offline': False}
+
+#start a mock vPIC server and point the pipeline at it, retries back off for milliseconds instead of seconds and
+#checkpoints are written to a temporary directory
+@pytest.fixture
+def mock_server(monkeypatch, tmp_path):
+    server = MockVpicServer().start()
+    monkeypatch.setattr(vin_pipeline, 'DECODE_VIN_URL', server.url + 'DecodeVin/')
+    monkeypatch.setattr(vin_pipeline, 'DECODE_BATCH_URL', server.url + 'DecodeVINValuesBatch/')
+    monkeypatch.setattr(vin_pipeline, 'BACKOFF', 0.001)
+    monkeypatch.setattr(vin_pipeline, 'CHECKPOINT_DIR', str(tmp_path / 'checkpoints'))
+    monkeypatch.setattr(vin_pipeline.RATE_LIMITER, 'rate', 0)
+    yield server
+    server.stop()
+
+#path of a file in the examples directory
+def example(name):
+    return os.path.join(EXAMPLES_DIR, name)
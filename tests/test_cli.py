@@ -0,0 +1,16 @@
+#tests of the command line interface
+
+#import necessary packages
+import shutil
+
+import vin_cli
+from conftest import example
+
+#templates that would write the same output files stop the run before any template is processed
+def test_clashing_templates(tmp_path):
+    for name in ('fleet.xlsx', 'Fleet.csv', 'other.xlsx'):
+        shutil.copy(example('Vin Example .xlsx'), tmp_path / name)
+    templates = vin_cli.find_templates(str(tmp_path))
+    assert vin_cli.clashing_templates(templates) == [['Fleet.csv', 'fleet.xlsx']]
+    assert vin_cli.main([str(tmp_path), '--no-store']) == 1
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['Fleet.csv', 'fleet.xlsx', 'other.xlsx']
@@ -0,0 +1,49 @@
+#tests of the vPIC extract builder of the offline decoder
+
+#import necessary packages
+import sqlite3
+
+import vin_extract
+import vin_pipeline
+
+#the vPIC tables read by the extract builder, only the columns it reads
+VPIC_SCHEMA = '''
+    CREATE TABLE Wmi (Id INTEGER, Wmi TEXT, VehicleTypeId INTEGER);
+    CREATE TABLE Wmi_Make (WmiId INTEGER, MakeId INTEGER);
+    CREATE TABLE Make (Id INTEGER, Name TEXT);
+    CREATE TABLE VehicleType (Id INTEGER, Name TEXT);
+    CREATE TABLE Wmi_VinSchema (Id INTEGER, WmiId INTEGER, VinSchemaId INTEGER, YearFrom INTEGER, YearTo INTEGER);
+    CREATE TABLE Element (Id INTEGER, Name TEXT);
+    CREATE TABLE Pattern (Id INTEGER, VinSchemaId INTEGER, Keys TEXT, ElementId INTEGER, AttributeId TEXT);
+    CREATE TABLE Model (Id INTEGER, Name TEXT);
+    CREATE TABLE FuelType (Id INTEGER, Name TEXT);
+    INSERT INTO Wmi VALUES (1, '1FT', 3), (2, '5NP', 2);
+    INSERT INTO Wmi_Make VALUES (1, 460), (2, 498), (2, 523);
+    INSERT INTO Make VALUES (460, 'Ford'), (498, 'Hyundai'), (523, 'Kia');
+    INSERT INTO VehicleType VALUES (2, 'Passenger Car'), (3, 'Truck ');
+    INSERT INTO Wmi_VinSchema VALUES (1, 1, 10, 2015, NULL), (2, 2, 20, 2015, NULL);
+    INSERT INTO Element VALUES (28, 'Model'), (24, 'Fuel Type - Primary');
+    INSERT INTO Model VALUES (1801, 'F-250'), (1802, 'F-350'), (1900, 'Sonata');
+    INSERT INTO FuelType VALUES (1, 'Diesel'), (4, 'Gasoline');
+    INSERT INTO Pattern VALUES (1, 10, '7X2B6', 28, '1801'), (2, 10, '7X2B6', 24, '1'),
+                               (3, 10, '7X3B6', 28, '1802'), (4, 10, '7X3B5', 24, '4'),
+                               (5, 20, 'E2AA', 28, '1900');
+'''
+
+#the extract holds WMIs of a single make and the model patterns with a single fuel type, and the offline decoder
+#decodes VINs from it the way DecodeVin does
+def test_build_offline_extract(tmp_path):
+    vpic_path = str(tmp_path / 'vpic.sqlite3')
+    extract_path = str(tmp_path / 'extract.sqlite3')
+    with sqlite3.connect(vpic_path) as conn:
+        conn.executescript(VPIC_SCHEMA)
+    assert vin_extract.build_offline_extract(vpic_path, extract_path) == (1, 1)
+
+    with sqlite3.connect(extract_path) as conn:
+        assert conn.execute('SELECT * FROM wmi').fetchall() == [('1FT', 'FORD', 'TRUCK ')]
+        assert conn.execute('SELECT * FROM pattern').fetchall() == [('1FT', 2015, None, '7X2B6', 'F-250', 'Diesel')]
+
+    decoder = vin_pipeline.OfflineDecoder.from_sqlite(extract_path)
+    assert decoder.decode('1FT7X2B65KEC43753') == {'Model Year': '2019', 'Make': 'FORD', 'Model': 'F-250',
+                                                   'Fuel Type - Primary': 'Diesel', 'Vehicle Type': 'TRUCK ',
+                                                   'Error Text': vin_pipeline.CLEAN_DECODE_TEXT}
@@ -0,0 +1,39 @@
+#tests of the background jobs uploads are processed as
+
+#import necessary packages
+import time
+
+import vin_jobs
+import vin_pipeline
+from conftest import OPTIONS, example
+
+EXAMPLE_TEMPLATE = example('Vin Example .xlsx')
+
+#wait until a job has finished and return it
+def wait_for_job(manager, job_id, timeout = 30):
+    deadline = time.monotonic() + timeout
+    while manager.get(job_id)['status'] not in (vin_jobs.DONE, vin_jobs.FAILED):
+        assert time.monotonic() < deadline, 'the job did not finish'
+        time.sleep(0.01)
+    return manager.get(job_id)
+
+#a job interrupted by a restart of the server is run again with the options and baseline it was submitted with,
+#so a job submitted with a baseline still only decodes the rows that changed
+def test_restarted_job_keeps_options(mock_server, monkeypatch, tmp_path):
+    monkeypatch.setattr(vin_jobs, 'get_result_cache', vin_pipeline.ResultCache)
+    monkeypatch.setattr(vin_jobs, 'get_fleet_store', lambda: None)
+    options = dict(OPTIONS, resume = False, suggest = False)
+    data = vin_pipeline.read_upload(EXAMPLE_TEMPLATE)
+    baseline = vin_pipeline.confirm_vin(data, **options)[2]
+
+    #a job left queued by the previous server process
+    store = vin_jobs.JobStore(str(tmp_path / 'jobs.sqlite3'))
+    job_id = store.create('key', 'fleet', data, options, baseline)
+    assert store.unfinished() == [(job_id, data, dict(options, baseline = baseline))]
+
+    mock_server.reset_stats()
+    job = wait_for_job(vin_jobs.JobManager(store), job_id)
+    assert job['status'] == vin_jobs.DONE and job['pending'] == 0
+    assert job['diagnostics']['cache']['baseline_rows'] > 0
+    assert mock_server.stats['requests'] == 0
+    assert store.unfinished() == []
@@ -0,0 +1,106 @@
+#tests of the NHTSA lookups shared between uploads, coalescing of in-flight VINs, the priority rate limiter and
+#uploads decoded while NHTSA is down
+
+#import necessary packages
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pandas as pd
+import pytest
+import requests
+
+import vin_pipeline
+from conftest import OPTIONS, example
+
+EXAMPLE_TEMPLATE = example('Vin Example .xlsx')
+
+#wait until the mock server has received a request, so an upload started afterwards finds the VINs in flight
+def wait_for_request(server, timeout = 5):
+    deadline = time.monotonic() + timeout
+    while server.stats['requests'] == 0:
+        assert time.monotonic() < deadline, 'no request reached the mock server'
+        time.sleep(0.005)
+
+#two identical uploads processed at the same time send the requests of a single upload, the second upload waits
+#for the VINs the first one is fetching
+def test_concurrent_uploads_coalesced(mock_server):
+    options = dict(OPTIONS, resume = False, suggest = False)
+    results, valid_vins, pending = vin_pipeline.decode_upload(EXAMPLE_TEMPLATE, **options)
+    requests_per_upload = mock_server.stats['requests']
+    assert requests_per_upload > 0 and pending == 0
+
+    mock_server.reset_stats()
+    mock_server.latency = 0.3
+    with ThreadPoolExecutor(max_workers = 2) as executor:
+        first = executor.submit(vin_pipeline.decode_upload, EXAMPLE_TEMPLATE, **options)
+        wait_for_request(mock_server)
+        second = executor.submit(vin_pipeline.decode_upload, EXAMPLE_TEMPLATE, **options)
+        uploads = [first.result(), second.result()]
+    assert mock_server.stats['requests'] == requests_per_upload
+    for upload_results, upload_valid_vins, upload_pending in uploads:
+        pd.testing.assert_frame_equal(upload_results, results)
+        assert upload_pending == 0
+
+#an error stopping a fetch is raised in every lookup waiting on the fetch, and the VINs are fetched again by the
+#next lookup instead of waiting on the failed fetch
+def test_fetch_error_reaches_waiters(mock_server):
+    vins = sorted(mock_server.recordings)[:5]
+    mock_server.latency = 0.1
+    mock_server.error_rate = 1.0
+    with ThreadPoolExecutor(max_workers = 2) as executor:
+        first = executor.submit(vin_pipeline.lookup_vins, vins)
+        wait_for_request(mock_server)
+        second = executor.submit(vin_pipeline.lookup_vins, vins)
+        for lookup in (first, second):
+            with pytest.raises(requests.HTTPError):
+                lookup.result()
+    assert mock_server.stats['requests'] == vin_pipeline.MAX_RETRIES + 1
+
+    mock_server.reset_stats()
+    mock_server.error_rate = 0.0
+    assert all(decoded_values is not None for decoded_values in vin_pipeline.lookup_vins(vins))
+    assert mock_server.stats['requests'] == 1
+
+#a waiting interactive request is given the next token before bulk requests that have been waiting longer
+def test_interactive_requests_served_first():
+    limiter = vin_pipeline.RateLimiter(rate = 5, burst = 1)
+    limiter.acquire()
+    order = []
+    lock = threading.Lock()
+    def acquire(priority):
+        limiter.acquire(priority)
+        with lock:
+            order.append(priority)
+    threads = [threading.Thread(target = acquire, args = (vin_pipeline.BULK,)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    threads.append(threading.Thread(target = acquire, args = (vin_pipeline.INTERACTIVE,)))
+    threads[-1].start()
+    for thread in threads:
+        thread.join()
+    assert order == [vin_pipeline.INTERACTIVE] + [vin_pipeline.BULK] * 3
+
+#while NHTSA is down the VINs of an upload are reported as not decoded rather than as VINs NHTSA has no information
+#for, the upload is checkpointed instead of cached, and processing it again once NHTSA is back resumes it
+def test_outage_keeps_rows_pending(mock_server):
+    result_cache = vin_pipeline.ResultCache()
+    key = vin_pipeline.ResultCache.key(vin_pipeline.read_upload(EXAMPLE_TEMPLATE))
+    mock_server.error_rate = 1.0
+    result = vin_pipeline.process_upload(EXAMPLE_TEMPLATE, result_cache = result_cache, **OPTIONS)
+    pending = result[4]
+    assert pending > 0
+    processed = pd.read_excel(BytesIO(result[2]))
+    assert not processed.isin([vin_pipeline.NO_INFORMATION_TEXT]).any().any()
+    assert processed.isin([vin_pipeline.NOT_DECODED_TEXT]).any().any()
+    assert result_cache.get(key) is None
+    assert len(os.listdir(vin_pipeline.CHECKPOINT_DIR)) == 1
+
+    mock_server.error_rate = 0.0
+    result = vin_pipeline.process_upload(EXAMPLE_TEMPLATE, result_cache = result_cache, **OPTIONS)
+    assert result[4] == 0
+    assert result_cache.get(key) is result
+    assert os.listdir(vin_pipeline.CHECKPOINT_DIR) == []
@@ -0,0 +1,162 @@
+#tests of the decode pipeline against the mock vPIC server
+
+#import necessary packages
+from io import BytesIO
+
+import openpyxl
+import pandas as pd
+
+import vin_metrics
+import vin_pipeline
+from conftest import OPTIONS, example
+
+BLANK_TEMPLATE = example('MCF Deployment Template.xlsx')
+EXAMPLE_TEMPLATE = example('Vin Example .xlsx')
+
+#a template without vehicles produces output files holding only their headers and an empty fleet summary
+def test_blank_template(mock_server, tmp_path):
+    known_vehicles, unknown_vehicles, processed_data, can_data, pending = vin_pipeline.confirm_vin(BLANK_TEMPLATE, **OPTIONS)
+    assert (known_vehicles, unknown_vehicles, pending) == ('', '', 0)
+    assert can_data == b'VRN,VIN,YEAR,MAKE,MODEL,FUEL,COUNTRY\n'
+    assert mock_server.stats['requests'] == 0
+    
+    counts, unconfirmed, pending = vin_pipeline.stream_upload(BLANK_TEMPLATE, tmp_path / 'processed.xlsx',
+                                                              tmp_path / 'CAN.csv', **OPTIONS)
+    assert counts.empty and unconfirmed.empty and pending == 0
+    assert list(pd.read_excel(tmp_path / 'processed.xlsx').columns) == list(pd.read_excel(BytesIO(processed_data)).columns)
+
+#every kind of whitespace is removed from a VIN, not only spaces
+def test_whitespace_removed():
+    normalized = vin_pipeline.normalize_vins(pd.Series(['1FT7X2B65KEC43753 \xa0\xa0', '1FT7X2B6\t5KEC43753\n']))
+    assert normalized['VIN'].tolist() == ['1FT7X2B65KEC43753'] * 2
+    assert normalized['VIN CORRECTED'].tolist() == ['YES: Spaces Removed'] * 2
+    assert normalized['VIN ERROR'].isna().all()
+
+#a checkpoint whose last line was cut off by an interruption resumes from its complete lines, and the records
+#appended on resume are read back on the next resume instead of being lost behind the cut off line
+def test_torn_checkpoint_resumes(mock_server, tmp_path):
+    vins = sorted(mock_server.recordings)[:5]
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    decoded, error = vin_pipeline.decode_in_chunks(vins, checkpoint, chunk_size = 1)
+    assert error is None
+    with open(checkpoint, 'rb') as f:
+        lines = f.readlines()
+    with open(checkpoint, 'wb') as f:
+        f.write(b''.join(lines[:2]) + lines[2][:10])
+
+    mock_server.reset_stats()
+    assert vin_pipeline.decode_in_chunks(vins, checkpoint, chunk_size = 1) == (decoded, None)
+    assert mock_server.stats['requests'] == 3
+    mock_server.reset_stats()
+    assert vin_pipeline.decode_in_chunks(vins, checkpoint, chunk_size = 1) == (decoded, None)
+    assert mock_server.stats['requests'] == 0
+
+#a small template of mistyped VINs, a VIN with a wrong check digit (a 'G' typed for a '6'), a VIN NHTSA has no
+#information for (positions 4 and 5 swapped), the same kind of VIN recorded under another make, and a VIN with a
+#wrong check digit recorded under another model year
+SUGGESTION_TEMPLATE = b'''Vehicle Asset Name,Model Year,Make,Model,VIN,Fuel Type
+TRUCK 1,2012,Ford,F-350,1FDSE3FLXCDA2G594,Diesel
+TRUCK 2,2008,Ford,E-250,1FTEN24LX8DA02785,Gasoline
+TRUCK 3,2013,Chevrolet,E-350,1FTN2SEW7DDA18809,Gasoline
+TRUCK 4,2019,Ford,F-150,1FTEX1CP5JFC42279,Gasoline
+'''
+
+#candidates are ranked with single substitutions of commonly confused characters before swaps of neighbouring
+#characters, and candidates that cannot be the model year of the template are pruned
+def test_correction_candidates():
+    assert vin_pipeline.correction_candidates('1FDSE3FLXCDA2G594', 2012) == [
+        ('1FDSE3FLXCDA26594', "Replaced 'G' with '6' at position 14"), ('1FDSE3FLXCDA2G549', 'Swapped positions 16 and 17')]
+    assert vin_pipeline.correction_candidates('1FTEX1CP5JFC42279', 2018) == [('1FTEX1CP5JFC24279', 'Swapped positions 13 and 14')]
+    assert vin_pipeline.correction_candidates('1FTEX1CP5JFC42279', 2019) == []
+
+#makes agree ignoring case and punctuation when one contains the other or they share their first 4 characters,
+#empty template fields are not compared
+def test_matches_template():
+    decoded_values = {'Make': 'CHEVROLET', 'Model Year': '2014'}
+    assert vin_pipeline.matches_template(decoded_values, 'Chevy', 2014)
+    assert vin_pipeline.matches_template(decoded_values, 'chevrolet.', None)
+    assert vin_pipeline.matches_template(decoded_values, '', 2014)
+    assert not vin_pipeline.matches_template(decoded_values, 'Ford', 2014)
+    assert not vin_pipeline.matches_template(decoded_values, 'Chevrolet', 2015)
+
+#the highest ranked candidate decoding to the make and model year of the template is suggested and the row asks for
+#the suggestion to be confirmed, rows whose candidates disagree with the template get no suggestion
+def test_vin_suggestions(mock_server):
+    results, valid_vins, pending = vin_pipeline.decode_upload(BytesIO(SUGGESTION_TEMPLATE), resume = False, **OPTIONS)
+    assert results['VIN SUGGESTION'].tolist() == [
+        "1FDSE3FLXCDA26594: Replaced 'G' with '6' at position 14, decodes as FORD 2012",
+        '1FTNE24LX8DA02785: Swapped positions 4 and 5, decodes as FORD 2008', None, None]
+    assert (results['MANUAL CHECK NEEDED'] == 'YES: Confirm VIN Suggestion').tolist() == [True, True, False, False]
+
+    #turning suggestions off, as --no-suggest does, leaves the column empty and sends no verification requests
+    mock_server.reset_stats()
+    results, valid_vins, pending = vin_pipeline.decode_upload(BytesIO(SUGGESTION_TEMPLATE), resume = False, suggest = False, **OPTIONS)
+    assert results['VIN SUGGESTION'].isna().all()
+    assert 'YES: Confirm VIN Suggestion' not in results['MANUAL CHECK NEEDED'].tolist()
+    assert mock_server.stats['requests'] == 1
+
+#return the example template with the cells of the rows of some VINs changed, changes map a VIN to the new values of
+#its row by standard column name
+def edited_template(changes):
+    workbook = openpyxl.load_workbook(EXAMPLE_TEMPLATE)
+    sheet = workbook[vin_pipeline.TEMPLATE_SHEET]
+    positions = vin_pipeline.template_positions([cell.value for cell in sheet[vin_pipeline.HEADER_ROW + 1]])
+    for row in sheet.iter_rows(min_row = vin_pipeline.HEADER_ROW + 2):
+        for column, value in changes.get(str(row[positions['VIN']].value).strip(), {}).items():
+            row[positions[column]].value = value
+    data = BytesIO()
+    workbook.save(data)
+    return data.getvalue()
+
+#process a template, returns the result of confirm_vin and the number of NHTSA requests it sent
+def counted_run(data, **options):
+    with vin_metrics.record() as run:
+        result = vin_pipeline.confirm_vin(data, **options)
+    return result, run.summary()['api']['requests']
+
+#check two results of confirm_vin hold the same output, the processed workbooks are compared by their contents
+def assert_same_output(result, expected):
+    pd.testing.assert_frame_equal(pd.read_excel(BytesIO(result[2])), pd.read_excel(BytesIO(expected[2])))
+    assert result[:2] == expected[:2] and result[3:] == expected[3:]
+
+#processing a template against the _processed.xlsx file of an earlier version gives the same output as processing
+#it in full while only decoding the rows that are new or changed, VINs are sent one per request so the requests
+#count the VINs decoded
+def test_incremental_matches_full_run(mock_server):
+    options = dict(OPTIONS, resume = False, batch = False, suggest = False)
+    #a VIN NHTSA has no information for is carried forward as such
+    unknown = {'1FTRE1423XHA11788': {'VIN': 'XXTRE1423XHA11788'}}
+    baseline = vin_pipeline.confirm_vin(edited_template(unknown), **options)[2]
+    decoded, trailers = vin_pipeline.read_baseline(BytesIO(baseline))
+    assert decoded[('17', 'XXTRE1423XHA11788')] is None
+    #vehicle types filled from the model are filled again from the new model, trailers named by their model are known
+    assert decoded[('', '3RFNX6FA3FV671170')]['Vehicle Type'] is None
+    assert ('TR23', '59N1U1623JB009388') in trailers
+
+    template = edited_template(dict(unknown, **{
+        #a new VRN and a new VIN are decoded again
+        '1GCWGAFP9M1227123': {'Vehicle Asset Name': '25A'},
+        '1FTNW20FX2EB82011': {'VIN': '1FTNW20FX2EB82012'},
+        #an unknown vehicle type becomes a lift as the model now names a lift, without decoding the VIN again
+        '3RFNX6FA3FV671170': {'Model': 'F650 scissor lift'},
+        #a trailer whose model no longer names a trailer is decoded again
+        '59N1U1623JB009388': {'Model': 'UTILITY BODY'}}))
+    full, full_requests = counted_run(template, **options)
+    incremental, incremental_requests = counted_run(template, baseline = BytesIO(baseline), **options)
+    assert_same_output(incremental, full)
+    assert incremental_requests == 3 and full_requests > 20
+
+#rows not decoded because processing stopped early have every decoded column set to 'Error', they are not carried
+#forward so the next run decodes them
+def test_incremental_after_outage(mock_server):
+    options = dict(OPTIONS, resume = False, batch = False, suggest = False)
+    mock_server.error_rate = 1.0
+    baseline = vin_pipeline.confirm_vin(EXAMPLE_TEMPLATE, **options)
+    assert baseline[4] > 0
+    assert vin_pipeline.read_baseline(BytesIO(baseline[2])) == ({}, set())
+
+    mock_server.error_rate = 0.0
+    full, full_requests = counted_run(EXAMPLE_TEMPLATE, **options)
+    incremental, incremental_requests = counted_run(EXAMPLE_TEMPLATE, baseline = BytesIO(baseline[2]), **options)
+    assert_same_output(incremental, full)
+    assert incremental_requests == full_requests
@@ -0,0 +1,228 @@
+#benchmark suite of the VIN decoder, runs confirm_vin end to end on generated fleets against a local stand-in for
+#the NHTSA vPIC API and records VINs per second, the time spent in each stage of the pipeline and peak memory,
+#results are written to a JSON file so runs can be compared
+#
+#example: python vin_benchmark.py --sizes 100,2000,50000 --latency 0.25 --error-rate 0.01 --rate-limit 20
+#         python vin_benchmark.py --sizes 2000 --client-rate-limit 0
+#         python vin_benchmark.py --sizes 2000 --compare benchmark_results/benchmark_20240101_120000.json
+
+#import necessary packages
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import openpyxl
+
+#peak memory is read from the operating system, it is not reported on platforms without the resource module
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import vin_metrics
+import vin_pipeline
+from vin_mock_server import MockVpicServer, load_recordings, record_responses
+
+#directory the benchmark results are written to
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results')
+
+#example template the generated fleets are built from
+EXAMPLE_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples', 'Vin Example .xlsx')
+
+#fleet sizes benchmarked by default
+DEFAULT_SIZES = [100, 2000, 50000]
+
+#stages of the pipeline timed by the benchmark, post-process includes normalizing the VINs, decode includes
+#verifying VIN suggestions with NHTSA and excel write includes the small CAN csv
+STAGES = ['ingest', 'decode', 'post_process', 'excel_write', 'summary']
+
+#read the vehicle rows of the example template, rows without a VIN are skipped
+def example_rows(path = EXAMPLE_TEMPLATE):
+    workbook = openpyxl.load_workbook(path, read_only = True)
+    sheet = workbook[vin_pipeline.TEMPLATE_SHEET]
+    sheet.reset_dimensions()
+    rows = list(sheet.iter_rows(min_row = vin_pipeline.HEADER_ROW + 1, values_only = True))
+    workbook.close()
+    #the header is on the row after the first HEADER_ROW rows, the vehicles follow it
+    vin_column = vin_pipeline.template_positions(rows[0])['VIN']
+    return [list(row) for row in rows[1:] if vin_column < len(row) and row[vin_column] is not None], vin_column
+
+#generate a fleet of size vehicles from the example template, example rows are repeated and every 17 character
+#VIN gets a new serial number (positions 12 to 17) and a matching check digit so the fleet has unique VINs that
+#decode like the example VINs, VINs that cannot be valid are repeated as they are
+def make_fleet(size, path, seed = 0):
+    rows, vin_column = example_rows()
+    generator = random.Random(seed)
+    workbook = openpyxl.load_workbook(EXAMPLE_TEMPLATE)
+    sheet = workbook[vin_pipeline.TEMPLATE_SHEET]
+    sheet.delete_rows(vin_pipeline.HEADER_ROW + 2, sheet.max_row)
+    for number in range(size):
+        row = list(rows[number % len(rows)])
+        vin = str(row[vin_column]).strip().upper()
+        if number >= len(rows) and len(vin) == 17 and vin_pipeline.check_digit(vin) is not None:
+            vin = vin[:11] + '%06d' % generator.randrange(1000000)
+            row[vin_column] = vin[:8] + vin_pipeline.check_digit(vin) + vin[9:]
+        sheet.append(row)
+    workbook.save(path)
+    return path
+
+#return the peak memory used by this process in MB, None where the operating system does not report it
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #linux reports kilobytes, macOS reports bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+#return the time spent in each stage of the benchmark from the diagnostics of a run, normalizing is counted as
+#post-processing, suggesting corrections for VINs that could not be decoded is counted as decoding as it waits on
+#NHTSA as well
+def run_stages(run):
+    stages = dict.fromkeys(STAGES, 0.0)
+    for stage, stage_seconds in run.summary()['stages'].items():
+        stage = 'post_process' if stage == 'normalize' else stage
+        if stage in stages:
+            stages[stage] += stage_seconds
+    return {stage: round(stages[stage], 3) for stage in STAGES}
+
+#run confirm_vin on a fleet in a fresh worker process so peak memory is measured for this fleet only, the
+#pipeline is pointed at the mock server, its requests are limited to client_rate_limit requests per second and the
+#stages are taken from the run diagnostics, which are recorded even when turned off for the application
+def run_fleet(path, url, options, client_rate_limit):
+    vin_pipeline.DECODE_VIN_URL = url + 'DecodeVin/'
+    vin_pipeline.DECODE_BATCH_URL = url + 'DecodeVINValuesBatch/'
+    vin_pipeline.RATE_LIMITER.rate = client_rate_limit
+    vin_metrics.ENABLED = True
+    baseline_memory = peak_memory_mb()
+    start = time.perf_counter()
+    with vin_metrics.record() as run:
+        pending = vin_pipeline.confirm_vin(path, **options)[4]
+    seconds = time.perf_counter() - start
+    rows = run.summary()['rows']
+    return {'vins': rows, 'pending': pending, 'seconds': round(seconds, 3), 'vins_per_sec': round(rows / seconds, 1),
+            'stages': run_stages(run), 'baseline_memory_mb': baseline_memory, 'peak_memory_mb': peak_memory_mb()}
+
+#run stream_upload on a fleet in a fresh worker process, streaming mode works through the stages chunk by chunk,
+#the stages are taken from the run diagnostics as in run_fleet
+def run_stream_fleet(path, url, options, client_rate_limit):
+    vin_pipeline.DECODE_VIN_URL = url + 'DecodeVin/'
+    vin_pipeline.DECODE_BATCH_URL = url + 'DecodeVINValuesBatch/'
+    vin_pipeline.RATE_LIMITER.rate = client_rate_limit
+    vin_metrics.ENABLED = True
+    options = {name: value for name, value in options.items() if name != 'resume'}
+    baseline_memory = peak_memory_mb()
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory, vin_metrics.record() as run:
+        counts, unconfirmed, pending = vin_pipeline.stream_upload(path, os.path.join(directory, 'processed.xlsx'),
+                                                                  os.path.join(directory, 'CAN.csv'), **options)
+    seconds = time.perf_counter() - start
+    rows = int(counts.sum())
+    return {'vins': rows, 'pending': pending, 'seconds': round(seconds, 3), 'vins_per_sec': round(rows / seconds, 1),
+            'stages': run_stages(run), 'baseline_memory_mb': baseline_memory, 'peak_memory_mb': peak_memory_mb()}
+
+#return the commit of the code being benchmarked, None outside of a git checkout
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True,
+                              cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#print the VINs per second of every fleet size next to the VINs per second of a previous run, settings that differ
+#from the previous run are listed first as the runs are not directly comparable, a setting missing from an older
+#results file is shown as None
+def compare(results, previous_path):
+    with open(previous_path) as f:
+        previous_results = json.load(f)
+    previous = {run['size']: run for run in previous_results['runs']}
+    print(f'\nCompared to {previous_path}')
+    settings, previous_settings = results['settings'], previous_results.get('settings', {})
+    for name in sorted(set(settings) | set(previous_settings)):
+        if settings.get(name) != previous_settings.get(name):
+            print(f'{name} changed: {previous_settings.get(name)} -> {settings.get(name)}')
+    for run in results['runs']:
+        if run['size'] not in previous:
+            continue
+        before = previous[run['size']]['vins_per_sec']
+        print(f"{run['size']:>7} VINs: {before:>8.1f} -> {run['vins_per_sec']:>8.1f} VINs/sec ({run['vins_per_sec'] / before:.2f}x)")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description = 'Benchmark the VIN decoder against a local stand-in for the NHTSA API.')
+    parser.add_argument('--sizes', default = ','.join(map(str, DEFAULT_SIZES)), help = 'comma separated fleet sizes to benchmark')
+    parser.add_argument('--latency', type = float, default = 0.25, help = 'seconds every NHTSA request takes')
+    parser.add_argument('--error-rate', type = float, default = 0.0, help = 'fraction of NHTSA requests answered with a 500 error')
+    parser.add_argument('--rate-limit', type = int, default = 0, help = 'NHTSA requests per second before requests are throttled with a 429 error')
+    parser.add_argument('--client-rate-limit', type = float, default = vin_pipeline.RATE_LIMIT,
+                        help = 'NHTSA requests per second the decoder sends, defaults to the limit of the application, 0 turns it off')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the generated fleets and the simulated latency and errors')
+    parser.add_argument('--threads', type = int, default = vin_pipeline.MAX_WORKERS, help = 'NHTSA requests in flight at the same time')
+    parser.add_argument('--no-batch', action = 'store_true', help = 'send one NHTSA request per VIN')
+    parser.add_argument('--stream', action = 'store_true', help = 'benchmark the bounded-memory streaming mode')
+    parser.add_argument('--responses', help = 'JSON file of recorded DecodeVin responses, defaults to responses built from the example files')
+    parser.add_argument('--record', action = 'store_true', help = 'record the NHTSA responses of the example VINs to the --responses file and exit')
+    parser.add_argument('--output', default = RESULTS_DIR, help = 'directory the results are written to')
+    parser.add_argument('--compare', help = 'results file of a previous run to compare against')
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = parse_args(argv)
+    if args.record:
+        if args.responses is None:
+            print('--record needs the --responses file to write to', file = sys.stderr)
+            return 1
+        rows, vin_column = example_rows()
+        vins = sorted({str(row[vin_column]).strip().upper() for row in rows})
+        print(f'Recorded {len(record_responses(vins, args.responses))} of {len(vins)} example VINs to {args.responses}')
+        return 0
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    #the persistent caches, the local vPIC extract and checkpoints are turned off so every run decodes every VIN
+    options = {'batch': not args.no_batch, 'max_workers': args.threads, 'use_cache': False, 'use_offline': False,
+               'resume': False}
+    results = {'started': datetime.now().isoformat(timespec = 'seconds'), 'commit': git_commit(),
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'settings': {'latency': args.latency, 'error_rate': args.error_rate, 'rate_limit': args.rate_limit,
+                            'client_rate_limit': args.client_rate_limit, 'seed': args.seed, 'responses': args.responses, 'stream': args.stream, **options},
+               'runs': []}
+
+    server = MockVpicServer(load_recordings(args.responses), latency = args.latency, error_rate = args.error_rate,
+                            rate_limit = args.rate_limit, seed = args.seed)
+    #fleets are generated and run in fresh worker processes, a new process starts with the peak memory of the
+    #process that started it so this process never builds a fleet itself
+    context = multiprocessing.get_context('spawn')
+    with server, tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            with ProcessPoolExecutor(max_workers = 1, mp_context = context) as executor:
+                path = executor.submit(make_fleet, size, os.path.join(directory, f'fleet_{size}.xlsx'), args.seed).result()
+            server.reset_stats()
+            with ProcessPoolExecutor(max_workers = 1, mp_context = context) as executor:
+                run = executor.submit(run_stream_fleet if args.stream else run_fleet, path, server.url, options,
+                                     args.client_rate_limit).result()
+            run = {'size': size, **run, 'server': dict(server.stats)}
+            results['runs'].append(run)
+            stages = ', '.join(f'{stage} {run["stages"][stage]:.2f}s' for stage in STAGES)
+            print(f"{size:>7} VINs: {run['seconds']:>8.2f}s {run['vins_per_sec']:>8.1f} VINs/sec, peak memory "
+                  f"{run['peak_memory_mb']} MB, {run['server']['requests']} requests ({run['server']['throttled']} "
+                  f"throttled, {run['server']['errors']} errors), {run['pending']} not decoded\n         {stages}")
+
+    #write the results, named by the time the run started
+    os.makedirs(args.output, exist_ok = True)
+    output_path = os.path.join(args.output, 'benchmark_{}.json'.format(datetime.now().strftime('%Y%m%d_%H%M%S')))
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent = 2)
+    print(f'Results written to {output_path}')
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#command line interface of the VIN decoder, processes every MCF deployment template in a directory across a pool of
+#processes without starting Streamlit, writes the _processed.xlsx and _CAN.csv files of every template and a
+#combined fleet summary of all the templates
+#
+#example: python vin_cli.py nightly_drop/ --output processed/ --processes 4
+
+#import necessary packages
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import vin_metrics
+from vin_pipeline import BULK, MAX_WORKERS, RATE_LIMITER, decode_outputs, format_fleet_summary, stream_upload, summarize_fleet
+from vin_store import STORE_PATH, FleetStore
+
+#file types the VIN decoder reads
+TEMPLATE_EXTENSIONS = ('.xlsx', '.xls', '.csv')
+
+#name of the combined fleet summary written to the output directory
+SUMMARY_FILE = 'combined_summary.csv'
+
+#return the templates in a directory, output files written by a previous run and Excel lock files are skipped
+def find_templates(directory):
+    templates = []
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(TEMPLATE_EXTENSIONS) or name.startswith('~$'):
+            continue
+        if name.endswith('_processed.xlsx') or name.endswith('_CAN.csv') or name == SUMMARY_FILE:
+            continue
+        templates.append(os.path.join(directory, name))
+    return templates
+
+#return the groups of templates that would write the same output files, the output files are named after the
+#template without its extension so fleet.xlsx and fleet.csv clash, names are compared ignoring case as on Windows
+#and macOS file systems
+def clashing_templates(templates):
+    stems = {}
+    for path in templates:
+        stems.setdefault(os.path.splitext(os.path.basename(path))[0].lower(), []).append(os.path.basename(path))
+    return [names for names in stems.values() if len(names) > 1]
+
+#process a single template in a worker process, writes its output files to output_dir and returns its fleet
+#summary, errors are reported in the returned summary so one bad template does not stop the others, the run
+#diagnostics of every template are logged as a JSON line, in streaming mode the output files are written as the
+#template is processed so memory use does not grow with the size of the template, in incremental mode the
+#_processed.xlsx file of a previous run is the baseline and only rows that are new or changed since are decoded
+def process_file(file_path, output_dir, options, stream = False, incremental = False):
+    name = os.path.basename(file_path)
+    #the output files have the same name as the template with _processed and _CAN appended
+    output_path = os.path.join(output_dir, os.path.splitext(name)[0])
+    if incremental and os.path.exists(output_path + '_processed.xlsx'):
+        options = dict(options, baseline = output_path + '_processed.xlsx')
+    try:
+        #streamed templates resume from the VIN cache rather than checkpoints
+        if stream:
+            options = {option: value for option, value in options.items() if option != 'resume'}
+            counts, unconfirmed, pending = stream_upload(file_path, output_path + '_processed.xlsx',
+                                                         output_path + '_CAN.csv', name = name, **options)
+            return {'file': name, 'error': None, 'rows': int(counts.sum()), 'pending': pending, 'counts': counts.to_dict()}
+        with vin_metrics.record():
+            results, processed_data, can_data, pending = decode_outputs(file_path, name = name, **options)
+        with open(output_path + '_processed.xlsx', 'wb') as f:
+            f.write(processed_data)
+        with open(output_path + '_CAN.csv', 'wb') as f:
+            f.write(can_data)
+        counts, unconfirmed = summarize_fleet(results)
+    except Exception as e:
+        return {'file': name, 'error': f'{type(e).__name__}: {e}'}
+    return {'file': name, 'error': None, 'rows': len(results), 'pending': pending, 'counts': counts.to_dict()}
+
+#the rate limiter is process-wide, each worker process gets an equal share of the rate of a single process
+def share_rate_limit(rate):
+    RATE_LIMITER.rate = rate
+
+#build the combined fleet summary, one row per template and vehicle type followed by the totals over all templates
+def combined_summary(summaries):
+    rows = [(summary['file'], vehicle, count) for summary in summaries if summary['error'] is None
+            for vehicle, count in summary['counts'].items()]
+    combined = pd.DataFrame(rows, columns = ['FILE', 'VEHICLE', 'COUNT'])
+    totals = combined.groupby('VEHICLE', as_index = False)['COUNT'].sum().assign(FILE = 'ALL FILES')
+    return pd.concat([combined, totals[['FILE', 'VEHICLE', 'COUNT']]], ignore_index = True)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description = 'Decode the VINs of every MCF deployment template in a directory.')
+    parser.add_argument('directory', help = 'directory holding the templates to process')
+    parser.add_argument('--output', help = 'directory the output files are written to, defaults to the template directory')
+    parser.add_argument('--processes', type = int, default = min(4, os.cpu_count() or 1),
+                        help = 'number of templates processed at the same time')
+    parser.add_argument('--threads', type = int, default = None,
+                        help = 'NHTSA requests in flight per process, defaults to sharing %d requests between the processes' % MAX_WORKERS)
+    parser.add_argument('--no-batch', action = 'store_true', help = 'send one NHTSA request per VIN')
+    parser.add_argument('--no-cache', action = 'store_true', help = 'do not use the persistent VIN cache')
+    parser.add_argument('--no-offline', action = 'store_true', help = 'do not use the local vPIC extract')
+    parser.add_argument('--no-resume', action = 'store_true', help = 'do not checkpoint or resume templates')
+    parser.add_argument('--no-suggest', action = 'store_true', help = 'do not suggest corrections of VINs that could not be decoded')
+    parser.add_argument('--incremental', action = 'store_true',
+                        help = 'only decode rows that are new or changed since the _processed.xlsx file of a previous run')
+    parser.add_argument('--store', default = STORE_PATH, help = 'fleet store the results are appended to, defaults to the store of the application')
+    parser.add_argument('--no-store', action = 'store_true', help = 'do not append the results to the fleet store')
+    parser.add_argument('--stream', action = 'store_true',
+                        help = 'process templates in chunks so memory use does not grow with the size of the template')
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = parse_args(argv)
+    output_dir = args.output or args.directory
+    os.makedirs(output_dir, exist_ok = True)
+    processes = max(1, args.processes)
+    #keep the total number of NHTSA requests in flight the same as a single upload unless told otherwise
+    threads = args.threads if args.threads is not None else max(1, MAX_WORKERS // processes)
+    options = {'batch': not args.no_batch, 'max_workers': threads, 'use_cache': not args.no_cache,
+               'use_offline': not args.no_offline, 'resume': not args.no_resume, 'suggest': not args.no_suggest,
+               'store': FleetStore(args.store) if not args.no_store else None, 'priority': BULK}
+
+    templates = find_templates(args.directory)
+    if not templates:
+        print(f'No templates found in {args.directory}', file = sys.stderr)
+        return 1
+    #templates writing the same output files would overwrite each other's results and baselines
+    clashes = clashing_templates(templates)
+    if clashes:
+        for names in clashes:
+            print(f"{', '.join(names)}: same output file names, rename all but one of these templates", file = sys.stderr)
+        return 1
+
+    #process the templates across the process pool, report each template as it finishes
+    summaries = []
+    with ProcessPoolExecutor(max_workers = processes, initializer = share_rate_limit,
+                             initargs = (RATE_LIMITER.rate / processes,)) as executor:
+        for summary in executor.map(process_file, templates, [output_dir] * len(templates), [options] * len(templates),
+                                    [args.stream] * len(templates), [args.incremental] * len(templates)):
+            summaries.append(summary)
+            if summary['error'] is not None:
+                print(f"{summary['file']}: FAILED {summary['error']}", file = sys.stderr)
+            elif summary['pending']:
+                print(f"{summary['file']}: {summary['rows']} VINs, {summary['pending']} not decoded, run again to resume")
+            else:
+                print(f"{summary['file']}: {summary['rows']} VINs")
+
+    #write the combined fleet summary and show the totals over all templates
+    combined = combined_summary(summaries)
+    combined.to_csv(os.path.join(output_dir, SUMMARY_FILE), index = False)
+    totals = combined[combined['FILE'] == 'ALL FILES'].set_index('VEHICLE')['COUNT']
+    known_vehicles, unknown_vehicles = format_fleet_summary(totals, pd.DataFrame(columns = ['VIN', 'MAKE', 'MODEL']))
+    print('\nFleet Summary\n' + known_vehicles)
+    return 1 if any(summary['error'] is not None for summary in summaries) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
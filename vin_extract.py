@@ -0,0 +1,105 @@
+#builds the vPIC extract read by the offline decoder (see OfflineDecoder in vin_pipeline) from a SQLite copy of the
+#NHTSA vPIC standalone database, NHTSA publishes the database as a SQL Server backup which has to be converted to
+#SQLite first keeping its table and column names, only the Wmi, Wmi_Make, Make, VehicleType, Wmi_VinSchema,
+#Pattern, Element, Model and FuelType tables are read
+#
+#example: python vin_extract.py vPICList_Lite.sqlite3
+
+#import necessary packages
+import argparse
+import os
+import sqlite3
+import sys
+
+from vin_pipeline import OFFLINE_DB_PATH
+
+#WMIs of a single make with their make and vehicle type, WMIs shared by several makes are left out so their VINs
+#are always sent to NHTSA, DecodeVin returns makes and vehicle types in upper case
+WMI_QUERY = '''
+    SELECT Wmi.Wmi, UPPER(MIN(Make.Name)), UPPER(VehicleType.Name)
+    FROM Wmi
+    JOIN Wmi_Make ON Wmi_Make.WmiId = Wmi.Id
+    JOIN Make ON Make.Id = Wmi_Make.MakeId
+    LEFT JOIN VehicleType ON VehicleType.Id = Wmi.VehicleTypeId
+    GROUP BY Wmi.Id
+    HAVING COUNT(DISTINCT Wmi_Make.MakeId) = 1
+'''
+
+#patterns of one element of every VIN schema with the WMIs and years the schema applies to, the attribute of a
+#pattern is the ID of its value in the lookup table of the element
+PATTERN_QUERY = '''
+    SELECT Wmi.Wmi, Wmi_VinSchema.YearFrom, Wmi_VinSchema.YearTo, Pattern.VinSchemaId, Pattern.Keys, {table}.Name
+    FROM Pattern
+    JOIN Element ON Element.Id = Pattern.ElementId
+    JOIN {table} ON {table}.Id = CAST(Pattern.AttributeId AS INTEGER)
+    JOIN Wmi_VinSchema ON Wmi_VinSchema.VinSchemaId = Pattern.VinSchemaId
+    JOIN Wmi ON Wmi.Id = Wmi_VinSchema.WmiId
+    WHERE Element.Name = ?
+'''
+
+#tables of the extract, see OfflineDecoder for their meaning
+EXTRACT_SCHEMA = '''
+    CREATE TABLE wmi (wmi TEXT PRIMARY KEY, make TEXT, vehicle_type TEXT);
+    CREATE TABLE pattern (wmi TEXT, year_from INTEGER, year_to INTEGER, keys TEXT, model TEXT, fuel_type TEXT);
+    CREATE INDEX pattern_wmi ON pattern (wmi);
+'''
+
+#return the fuel type of every model pattern, vPIC keeps the model and fuel type of a schema in separate patterns,
+#a model pattern takes the fuel type of the pattern with the same keys or the fuel type of its schema when the
+#schema only has one, model patterns without a single fuel type are left out so their VINs are sent to NHTSA
+def model_patterns(models, fuel_types):
+    by_keys = {}
+    by_schema = {}
+    for wmi, year_from, year_to, schema, keys, fuel_type in fuel_types:
+        by_keys.setdefault((schema, keys), set()).add(fuel_type)
+        by_schema.setdefault(schema, set()).add(fuel_type)
+    patterns = []
+    for wmi, year_from, year_to, schema, keys, model in models:
+        candidates = by_keys.get((schema, keys)) or by_schema.get(schema, set())
+        if len(candidates) == 1:
+            patterns.append((wmi, year_from, year_to, keys, model, next(iter(candidates))))
+    return patterns
+
+#build the extract of the offline decoder at path from a SQLite copy of the vPIC database, the extract is written
+#to a temporary file first so a running application never reads a partly written extract, returns the number of
+#WMIs and patterns written
+def build_offline_extract(vpic_path, path = OFFLINE_DB_PATH):
+    with sqlite3.connect(vpic_path) as conn:
+        wmis = conn.execute(WMI_QUERY).fetchall()
+        models = conn.execute(PATTERN_QUERY.format(table = 'Model'), ('Model',)).fetchall()
+        fuel_types = conn.execute(PATTERN_QUERY.format(table = 'FuelType'), ('Fuel Type - Primary',)).fetchall()
+    #only keep the patterns of WMIs in the extract
+    known = {wmi for wmi, make, vehicle_type in wmis}
+    patterns = [pattern for pattern in model_patterns(models, fuel_types) if pattern[0] in known]
+
+    temporary_path = path + '.tmp'
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    conn = sqlite3.connect(temporary_path)
+    try:
+        with conn:
+            conn.executescript(EXTRACT_SCHEMA)
+            conn.executemany('INSERT INTO wmi VALUES (?, ?, ?)', wmis)
+            conn.executemany('INSERT INTO pattern VALUES (?, ?, ?, ?, ?, ?)', patterns)
+    finally:
+        conn.close()
+    os.replace(temporary_path, path)
+    return len(wmis), len(patterns)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description = 'Build the vPIC extract of the offline decoder.')
+    parser.add_argument('vpic', help = 'SQLite copy of the NHTSA vPIC standalone database')
+    parser.add_argument('--output', default = OFFLINE_DB_PATH, help = 'extract written, defaults to the extract of the application')
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = parse_args(argv)
+    if not os.path.exists(args.vpic):
+        print(f'{args.vpic} not found', file = sys.stderr)
+        return 1
+    wmis, patterns = build_offline_extract(args.vpic, args.output)
+    print(f'{args.output}: {wmis} WMIs, {patterns} patterns')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+#background job queue of the VIN decoder, uploads are submitted as jobs and processed by a pool of worker threads
+#so long decodes do not block the Streamlit session that submitted them, job status, progress and results are kept
+#in a small SQLite job store so a page refresh, or another session, can reattach to a job by its ID
+
+#import necessary packages
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import vin_metrics
+from vin_pipeline import get_result_cache, process_upload, read_upload
+from vin_store import get_fleet_store
+
+#location of the job store, stored next to the application so jobs survive a restart of the server
+JOB_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.sqlite3')
+
+#number of uploads processed at the same time, each upload also sends several NHTSA requests at once
+JOB_WORKERS = 2
+
+#number of seconds finished jobs are kept before they are removed from the job store (7 days)
+JOB_TTL = 7 * 24 * 60 * 60
+
+#job statuses, queued and running jobs are active, done and failed jobs are finished
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+#columns of the jobs table, the upload, the options it was submitted with and its baseline are kept until the job
+#finishes so interrupted jobs can be run again as they were submitted
+JOB_COLUMNS = ['id', 'key', 'name', 'status', 'done', 'total', 'rate', 'eta', 'error', 'pending',
+               'known_vehicles', 'unknown_vehicles', 'processed_data', 'can_data', 'diagnostics', 'upload', 'options',
+               'baseline', 'created', 'updated']
+
+#columns only used to run the job, not returned with the job
+RUN_COLUMNS = ['upload', 'options', 'baseline']
+
+#persistent store of jobs, shared by the worker threads and every Streamlit session
+class JobStore:
+    def __init__(self, path = JOB_DB_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread = False, timeout = 30)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, key TEXT, name TEXT, status TEXT, '
+                           'done INTEGER, total INTEGER, rate REAL, eta REAL, error TEXT, pending INTEGER, '
+                           'known_vehicles TEXT, unknown_vehicles TEXT, processed_data BLOB, can_data BLOB, '
+                           'diagnostics TEXT, upload BLOB, options TEXT, baseline BLOB, created REAL, updated REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status)')
+        self._conn.commit()
+
+    #create a queued job for an upload and return its ID, options are the options the upload is processed with
+    #other than the baseline, which is given as the contents of the previous _processed.xlsx file
+    def create(self, key, name, upload, options = None, baseline = None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT INTO jobs (id, key, name, status, done, total, upload, options, baseline, created, '
+                               'updated) VALUES (?, ?, ?, ?, 0, 0, ?, ?, ?, ?, ?)',
+                               (job_id, key, name, QUEUED, upload, json.dumps(options or {}), baseline, now, now))
+            self._conn.commit()
+        return job_id
+
+    #update fields of a job
+    def update(self, job_id, **fields):
+        fields['updated'] = time.time()
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET {} WHERE id = ?'.format(', '.join(f'{name} = ?' for name in fields)),
+                               list(fields.values()) + [job_id])
+            self._conn.commit()
+
+    #return a job as a dictionary, None if there is no job with this ID, the upload, options and baseline are not
+    #returned and the run diagnostics are returned as a dictionary
+    def get(self, job_id):
+        columns = [column for column in JOB_COLUMNS if column not in RUN_COLUMNS]
+        with self._lock:
+            row = self._conn.execute('SELECT {} FROM jobs WHERE id = ?'.format(', '.join(columns)), (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(columns, row))
+        job['diagnostics'] = json.loads(job['diagnostics']) if job['diagnostics'] else None
+        return job
+
+    #return the ID of the active job processing an upload, None if the upload is not being processed
+    def active(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT id FROM jobs WHERE key = ? AND status IN (?, ?) ORDER BY created LIMIT 1',
+                                     (key, QUEUED, RUNNING)).fetchone()
+        return row[0] if row is not None else None
+
+    #return the IDs, uploads and options of the active jobs, the baseline is returned with the options, used to run
+    #jobs interrupted by a restart of the server again
+    def unfinished(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT id, upload, options, baseline FROM jobs WHERE status IN (?, ?) ORDER BY created',
+                                      (QUEUED, RUNNING)).fetchall()
+        jobs = []
+        for job_id, upload, options, baseline in rows:
+            options = json.loads(options) if options else {}
+            if baseline is not None:
+                options['baseline'] = baseline
+            jobs.append((job_id, upload, options))
+        return jobs
+
+    #remove finished jobs older than ttl seconds
+    def purge(self, ttl = JOB_TTL):
+        with self._lock:
+            self._conn.execute('DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?', (DONE, FAILED, time.time() - ttl))
+            self._conn.commit()
+
+#runs jobs on a pool of worker threads and records their progress and results in the job store
+class JobManager:
+    def __init__(self, store = None, workers = JOB_WORKERS):
+        self.store = store if store is not None else JobStore()
+        self._executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'vin-job')
+        self.store.purge()
+        #jobs left active by a previous server process were interrupted, run them again, their checkpoints let
+        #them resume from where they stopped
+        for job_id, upload, options in self.store.unfinished():
+            self.store.update(job_id, status = QUEUED)
+            self._executor.submit(self._run, job_id, upload, options)
+
+    #submit an upload as a job and return the job ID, an upload that is already being processed returns the ID
+    #of the existing job, options are passed to confirm_vin and must be JSON serializable, the upload is processed
+    #against the previous _processed.xlsx file given as baseline, a job interrupted by a restart of the server is run
+    #again with the same options and baseline
+    def submit(self, upload, name, baseline = None, **options):
+        data = read_upload(upload)
+        key = hashlib.sha256(data).hexdigest()
+        if baseline is not None:
+            baseline = read_upload(baseline)
+            key = hashlib.sha256(data + b'\0' + baseline).hexdigest()
+        job_id = self.store.active(key)
+        if job_id is None:
+            job_id = self.store.create(key, name, data, options, baseline)
+            if baseline is not None:
+                options['baseline'] = baseline
+            self._executor.submit(self._run, job_id, data, options)
+        return job_id
+
+    #return the status, progress and results of a job, None if there is no job with this ID
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    #process the upload of a job, recording progress as VINs are decoded and the results and run diagnostics once
+    #the job finishes, the results are also appended to the fleet store
+    def _run(self, job_id, data, options):
+        self.store.update(job_id, status = RUNNING)
+        name = self.store.get(job_id)['name']
+        def progress(done, total, rate, eta):
+            self.store.update(job_id, done = done, total = total, rate = rate, eta = eta)
+        run = None
+        try:
+            with vin_metrics.record() as run:
+                known_vehicles, unknown_vehicles, processed_data, can_data, pending = process_upload(
+                    data, get_result_cache(), progress = progress, store = get_fleet_store(), name = name, **options)
+        except Exception as e:
+            self.store.update(job_id, status = FAILED, error = f'{type(e).__name__}: {e}', upload = None,
+                              options = None, baseline = None,
+                              diagnostics = json.dumps(run.summary()) if run is not None else None)
+            return
+        self.store.update(job_id, status = DONE, pending = pending, known_vehicles = known_vehicles,
+                          unknown_vehicles = unknown_vehicles, processed_data = processed_data, can_data = can_data,
+                          diagnostics = json.dumps(run.summary()) if run is not None else None, upload = None,
+                          options = None, baseline = None)
+
+#the job manager shared by every Streamlit session in this process, created on first use
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+#return the shared job manager, creating it on first use
+def get_job_manager():
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager()
+        return _job_manager
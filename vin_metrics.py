@@ -0,0 +1,253 @@
+#lightweight instrumentation of the VIN decoder, records the wall time of each stage of a run, the latency and
+#status of every NHTSA request, retries, cache hit rates and rows per second, every finished run is written to the
+#log as a single JSON line and added to process-wide totals that can be served in the Prometheus text format
+#
+#set AUTOVIN_METRICS=0 to turn instrumentation off, set AUTOVIN_METRICS_PORT to serve the totals at /metrics
+
+#import necessary packages
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#instrumentation is on unless turned off, when off every call below returns straight away
+ENABLED = os.environ.get('AUTOVIN_METRICS', '1') != '0'
+
+#upper bounds in seconds of the NHTSA request latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+#finished runs are logged as JSON lines to stderr unless the application configures the logger itself
+logger = logging.getLogger('autovin.metrics')
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+#the run being recorded by each thread, worker threads decoding VINs for a run are bound to it with bind()
+_local = threading.local()
+
+#metrics of a single run of the pipeline
+class RunMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.seconds = None
+        self.error = None
+        self.stages = Counter()
+        self.counters = Counter()
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    #record the latency and outcome of a NHTSA request, status is the response status code or 'timeout', attempt
+    #is 0 for the first attempt and counts up for every retry
+    def add_request(self, seconds, status, attempt = 0):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.counters['requests'] += 1
+            if attempt:
+                self.counters['retries'] += 1
+            if status == 'timeout':
+                self.counters['timeouts'] += 1
+            elif status == 429:
+                self.counters['throttled'] += 1
+            elif status >= 500:
+                self.counters['server_errors'] += 1
+
+    def add_count(self, name, value = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            self.stages[name] += seconds
+
+    def finish(self, error = None):
+        self.seconds = time.perf_counter() - self._start
+        self.error = error
+
+    #return the number of requests in each latency bucket, the last bucket holds the requests slower than every bound
+    def histogram(self):
+        counts = Counter()
+        for seconds in self.latencies:
+            counts[next((bound for bound in LATENCY_BUCKETS if seconds <= bound), '+Inf')] += 1
+        return {str(bound): counts[bound] for bound in LATENCY_BUCKETS + ['+Inf']}
+
+    #return the metrics of the run as a dictionary that can be written as JSON
+    def summary(self):
+        seconds = self.seconds if self.seconds is not None else time.perf_counter() - self._start
+        counters = self.counters
+        latencies = sorted(self.latencies)
+        def percentile(share):
+            return round(latencies[min(len(latencies) - 1, int(share * len(latencies)))] * 1000, 1) if latencies else None
+        lookups = counters['vin_cache_hits'] + counters['vin_cache_misses']
+        return {
+            'event': 'run',
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'seconds': round(seconds, 3),
+            'rows': counters['rows'],
+            'rows_per_sec': round(counters['rows'] / seconds, 1) if seconds else None,
+            'vin_suggestions': counters['vin_suggestions'],
+            'error': self.error,
+            'stages': {name: round(value, 3) for name, value in self.stages.items()},
+            'api': {'requests': counters['requests'], 'vins': counters['api_vins'], 'retries': counters['retries'],
+                    'throttled': counters['throttled'], 'server_errors': counters['server_errors'],
+                    'timeouts': counters['timeouts'], 'coalesced_vins': counters['coalesced_vins'],
+                    'rate_limit_wait_sec': round(counters['rate_limit_wait_seconds'], 3),
+                    'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'max': percentile(1.0)},
+                    'histogram': self.histogram()},
+            'cache': {'result_cache_hits': counters['result_cache_hits'], 'vin_cache_hits': counters['vin_cache_hits'],
+                      'vin_cache_misses': counters['vin_cache_misses'],
+                      'vin_cache_hit_rate': round(counters['vin_cache_hits'] / lookups, 3) if lookups else None,
+                      'offline_hits': counters['offline_hits'], 'checkpoint_rows': counters['checkpoint_rows'],
+                      'baseline_rows': counters['baseline_rows']}
+        }
+
+#totals over every run of this process, served in the Prometheus text format
+class Registry:
+    def __init__(self):
+        self.runs = Counter()
+        self.stages = Counter()
+        self.counters = Counter()
+        self.buckets = Counter()
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self._lock = threading.Lock()
+
+    def add(self, run):
+        with self._lock:
+            self.runs['failed' if run.error else 'done'] += 1
+            self.stages.update(run.stages)
+            self.counters.update(run.counters)
+            self.buckets.update(run.histogram())
+            self.latency_sum += sum(run.latencies)
+            self.latency_count += len(run.latencies)
+
+    #return the totals in the Prometheus text exposition format
+    def prometheus_text(self):
+        with self._lock:
+            lines = ['# TYPE autovin_runs_total counter']
+            lines += [f'autovin_runs_total{{status="{status}"}} {count}' for status, count in sorted(self.runs.items())]
+            lines.append('# TYPE autovin_stage_seconds_total counter')
+            lines += [f'autovin_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}' for stage, seconds in sorted(self.stages.items())]
+            for name, count in sorted(self.counters.items()):
+                lines += [f'# TYPE autovin_{name}_total counter', f'autovin_{name}_total {count}']
+            lines.append('# TYPE autovin_api_request_seconds histogram')
+            cumulative = 0
+            for bound in LATENCY_BUCKETS + ['+Inf']:
+                cumulative += self.buckets[str(bound)]
+                lines.append(f'autovin_api_request_seconds_bucket{{le="{bound}"}} {cumulative}')
+            lines += [f'autovin_api_request_seconds_sum {self.latency_sum:.6f}',
+                      f'autovin_api_request_seconds_count {self.latency_count}']
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+#return the run recorded by this thread, None if no run is being recorded
+def current():
+    return getattr(_local, 'run', None)
+
+#record a run of the pipeline, yields the run metrics, or None when instrumentation is off, runs started inside
+#another run are part of the outer run, the outer run is logged and added to the totals once it finishes
+@contextmanager
+def record():
+    if not ENABLED or current() is not None:
+        yield current()
+        return
+    run = RunMetrics()
+    _local.run = run
+    try:
+        yield run
+    except BaseException as e:
+        run.finish(f'{type(e).__name__}: {e}')
+        raise
+    else:
+        run.finish()
+    finally:
+        _local.run = None
+        REGISTRY.add(run)
+        logger.info(json.dumps(run.summary()))
+
+#return a function that runs in the run of the calling thread, used to hand work to worker threads
+def bind(function):
+    run = current()
+    if run is None:
+        return function
+    def bound(*args, **kwargs):
+        _local.run = run
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.run = None
+    return bound
+
+#record the latency and outcome of a NHTSA request in the current run
+def request(seconds, status, attempt = 0):
+    run = current()
+    if run is not None:
+        run.add_request(seconds, status, attempt)
+
+#add to a counter of the current run
+def count(name, value = 1):
+    run = current()
+    if run is not None:
+        run.add_count(name, value)
+
+#times consecutive stages of the current run, each lap records the time since the previous lap under a stage name
+class Timer:
+    def __init__(self, run):
+        self.run = run
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.run.add_stage(stage, now - self._last)
+        self._last = now
+
+#timer used when no run is being recorded, laps are not recorded
+class NullTimer:
+    def lap(self, stage):
+        pass
+
+_NULL_TIMER = NullTimer()
+
+#return a timer for the stages of the current run
+def timer():
+    run = current()
+    return Timer(run) if run is not None else _NULL_TIMER
+
+#handler serving the totals of this process at /metrics
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+#serve the totals in the Prometheus text format at /metrics on a port, by default the port in AUTOVIN_METRICS_PORT,
+#nothing is served when no port is set, the server is only started once per process
+def serve_metrics(port = None):
+    global _metrics_server
+    port = port or os.environ.get('AUTOVIN_METRICS_PORT')
+    with _metrics_server_lock:
+        if _metrics_server is None and port and ENABLED:
+            _metrics_server = ThreadingHTTPServer(('', int(port)), MetricsHandler)
+            _metrics_server.daemon_threads = True
+            threading.Thread(target = _metrics_server.serve_forever, daemon = True).start()
+        return _metrics_server
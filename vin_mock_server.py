@@ -0,0 +1,255 @@
+#local stand-in for the NHTSA vPIC API used to benchmark the VIN decoder without sending requests to NHTSA, the
+#server replays recorded DecodeVin responses for the DecodeVin and DecodeVINValuesBatch endpoints and can add
+#latency, server errors and 429 throttling to every request
+#
+#example: python vin_mock_server.py --port 8080 --latency 0.2 --error-rate 0.01 --rate-limit 20
+
+#import necessary packages
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import pandas as pd
+import requests
+
+from vin_pipeline import DECODE_VIN_URL
+
+#example files holding the NHTSA decode of the example VINs, used to build the recorded responses when no
+#recording of the real NHTSA responses is given
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples')
+EXAMPLE_VIN_DATA = os.path.join(EXAMPLES_DIR, 'VIN Example_VIN_data.xlsx')
+EXAMPLE_PROCESSED = os.path.join(EXAMPLES_DIR, 'VIN Example_processed.xlsx')
+
+#columns of the example VIN data file and the DecodeVin variable each column was decoded from
+EXAMPLE_VARIABLES = {'Model Year': 'Model Year', 'Manufacturer': 'Manufacturer Name', 'Make': 'Make', 'Model': 'Model',
+                     'Trim': 'Trim', 'Weight Class': 'Gross Vehicle Weight Rating From', 'Body/Cab Type': 'Cab Type',
+                     'Body Class': 'Body Class', 'Drive Type': 'Drive Type', 'Fuel Type': 'Fuel Type - Primary',
+                     'Engine Model': 'Engine Model', 'Engine Configuration': 'Engine Configuration',
+                     'Engine Cyl': 'Engine Number of Cylinders', 'Displacement (Litres)': 'Displacement (L)',
+                     'Engine Horse Power': 'Engine Brake (hp) From', 'Transmission': 'Transmission Style',
+                     'Speeds': 'Transmission Speeds', 'Error Test': 'Error Text'}
+
+#VIN replayed for VINs with no recorded response, NHTSA reports the manufacturer of this VIN is not registered
+UNKNOWN_VIN = '59N1U1623JB009388'
+
+#DecodeVINValuesBatch returns every DecodeVin variable under its name with spaces and punctuation removed
+def batch_field(variable):
+    return re.sub('[^0-9A-Za-z]', '', variable)
+
+#return the recorded DecodeVin response of a VIN built from its decoded values
+def decode_response(vin, values):
+    results = [{'Value': None if pd.isna(value) else str(value), 'ValueId': '', 'Variable': variable,
+                'VariableId': number} for number, (variable, value) in enumerate(values.items(), start = 1)]
+    return {'Count': len(results), 'Message': 'Results returned successfully', 'SearchCriteria': f'VIN:{vin}',
+            'Results': results}
+
+#build recorded DecodeVin responses of the example VINs from the example VIN data and processed files, VINs NHTSA
+#found no information for are left out so they are answered with an empty response like NHTSA does
+def example_recordings():
+    vin_data = pd.read_excel(EXAMPLE_VIN_DATA)
+    vin_data['VIN'] = vin_data['VIN'].astype(str).str.strip()
+    processed = pd.read_excel(EXAMPLE_PROCESSED)
+    vehicle_types = dict(zip(processed['VIN'].astype(str).str.strip(), processed['VEHICLE TYPE']))
+    recordings = {}
+    for row in vin_data.to_dict('records'):
+        if row['Make'] == 'Error':
+            continue
+        values = {variable: row[column] for column, variable in EXAMPLE_VARIABLES.items()}
+        values['Vehicle Type'] = vehicle_types.get(row['VIN'])
+        recordings[row['VIN']] = decode_response(row['VIN'], values)
+    return recordings
+
+#record the real DecodeVin responses of a list of VINs from NHTSA and save them to a JSON file that can be replayed
+def record_responses(vins, path):
+    recordings = {}
+    for vin in vins:
+        #bypasses certification verification error created by Michelin firewalls
+        response = requests.get(DECODE_VIN_URL + vin + '?format=json', timeout = 30, verify = False)
+        try:
+            recordings[vin] = response.json()
+        #NHTSA found no information for the VIN
+        except json.JSONDecodeError:
+            continue
+    with open(path, 'w') as f:
+        json.dump(recordings, f)
+    return recordings
+
+#load recorded DecodeVin responses saved by record_responses, the example recordings are used without a file
+def load_recordings(path = None):
+    if path is None:
+        return example_recordings()
+    with open(path) as f:
+        return json.load(f)
+
+#HTTP handler answering DecodeVin and DecodeVINValuesBatch requests with the recordings of the server
+class MockVpicHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    #requests are counted by the server, do not log every request to stderr
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, headers = None):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json' if status == 200 else 'text/html')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    #apply the latency, throttling and error rate of the server, returns True if the request was answered with an
+    #error and should not be answered with a decode
+    def simulate(self, vins):
+        status = self.server.mock.admit(vins)
+        if status == 429:
+            self.send_body(429, 'Too Many Requests', {'Retry-After': '1'})
+        elif status != 200:
+            self.send_body(status, 'Internal Server Error')
+        return status != 200
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        vin = unquote(path.rsplit('/', 1)[-1])
+        if '/DecodeVin/' not in path or vin == '':
+            return self.send_body(404, 'Not Found')
+        if self.simulate(1):
+            return
+        response = self.server.mock.replay(vin)
+        #NHTSA answers VINs it found no information for with an empty response
+        self.send_body(200, json.dumps(response) if response is not None else '')
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        if '/DecodeVINValuesBatch/' not in urlparse(self.path).path or 'data' not in form:
+            return self.send_body(404, 'Not Found')
+        #VINs are sent as 'vin,year' entries separated by ';', the year is optional
+        vins = [entry.split(',')[0].strip() for entry in form['data'][0].split(';') if entry.strip()]
+        if self.simulate(len(vins)):
+            return
+        results = []
+        for vin in vins:
+            response = self.server.mock.replay(vin) or self.server.mock.replay(UNKNOWN_VIN) or {'Results': []}
+            row = {batch_field(item['Variable']): item['Value'] or '' for item in response['Results']}
+            row['VIN'] = vin
+            results.append(row)
+        self.send_body(200, json.dumps({'Count': len(results), 'Message': 'Results returned successfully',
+                                        'SearchCriteria': None, 'Results': results}))
+
+#local vPIC API replaying recorded responses, each request waits latency seconds (varied by +/- jitter), fails
+#with a 500 error with probability error_rate and is throttled with a 429 error once more than rate_limit
+#requests per second are sent, a rate_limit of 0 turns throttling off
+class MockVpicServer:
+    def __init__(self, recordings = None, latency = 0.0, jitter = 0.25, error_rate = 0.0, rate_limit = 0,
+                 seed = 0, host = '127.0.0.1', port = 0):
+        self.recordings = recordings if recordings is not None else example_recordings()
+        #VINs with no recording are answered with the recording of a VIN sharing its VIN mask, the vehicle
+        #descriptor and model year and plant codes, so generated VINs decode like the VIN they were made from
+        self._masks = {self.mask(vin): response for vin, response in self.recordings.items()}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = float(rate_limit)
+        self._refilled = time.monotonic()
+        self.reset_stats()
+        self._server = ThreadingHTTPServer((host, port), MockVpicHandler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = None
+
+    #base url of the server, replaces 'https://vpic.nhtsa.dot.gov/api/vehicles/'
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/api/vehicles/'
+
+    @staticmethod
+    def mask(vin):
+        return vin[:8] + vin[9:11] if len(vin) == 17 else vin
+
+    #return the recorded response of a VIN, None if NHTSA found no information for the VIN
+    def replay(self, vin):
+        vin = vin.upper()
+        return self.recordings.get(vin) or self._masks.get(self.mask(vin))
+
+    #count the requests sent to the server since the last reset
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {'requests': 0, 'vins': 0, 'throttled': 0, 'errors': 0}
+
+    #record a request for a number of VINs and decide how it is answered, sleeps for the latency of the request
+    #and returns the status code of the response
+    def admit(self, vins):
+        with self._lock:
+            self.stats['requests'] += 1
+            delay = self.latency * (1 + self._random.uniform(-self.jitter, self.jitter))
+            failed = self._random.random() < self.error_rate
+            #refill the token bucket at rate_limit tokens per second, a request without a token is throttled
+            throttled = False
+            if self.rate_limit:
+                now = time.monotonic()
+                self._tokens = min(float(self.rate_limit), self._tokens + (now - self._refilled) * self.rate_limit)
+                self._refilled = now
+                throttled = self._tokens < 1
+                if not throttled:
+                    self._tokens -= 1
+            if throttled:
+                self.stats['throttled'] += 1
+            elif failed:
+                self.stats['errors'] += 1
+            else:
+                self.stats['vins'] += vins
+        if throttled:
+            return 429
+        time.sleep(max(0.0, delay))
+        return 500 if failed else 200
+
+    def start(self):
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description = 'Run a local stand-in for the NHTSA vPIC API.')
+    parser.add_argument('--port', type = int, default = 8080, help = 'port the server listens on')
+    parser.add_argument('--responses', help = 'JSON file of recorded DecodeVin responses, defaults to the example VINs')
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'seconds every request waits before it is answered')
+    parser.add_argument('--error-rate', type = float, default = 0.0, help = 'fraction of requests answered with a 500 error')
+    parser.add_argument('--rate-limit', type = int, default = 0, help = 'requests per second before requests are throttled with a 429 error')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the simulated latency and errors')
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = parse_args(argv)
+    server = MockVpicServer(load_recordings(args.responses), latency = args.latency, error_rate = args.error_rate,
+                            rate_limit = args.rate_limit, seed = args.seed, port = args.port)
+    server.start()
+    print(f'Serving {len(server.recordings)} recorded VINs at {server.url}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
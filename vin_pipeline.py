@@ -0,0 +1,1423 @@
+#decode pipeline of the VIN decoder, reads an MCF deployment template, decodes its VINs with the NHTSA API and
+#produces the processed VINs workbook, the CAN compatability csv and the fleet summary, this module does not use
+#Streamlit so it can be imported by the Streamlit application, the command line interface and scheduled jobs
+
+#import necessary packages
+import pandas as pd
+import requests
+import os
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+from openpyxl.utils import get_column_letter
+import numpy as np
+import json
+import csv
+import io
+from datetime import datetime
+from io import BytesIO
+import hashlib
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from requests.adapters import HTTPAdapter
+
+import vin_metrics
+
+#vehicle types counted under their own name at the end of the fleet summary instead of by make and model
+BULK_VEHICLES = ['LIFT', 'TRAILER', 'UNCONFIRMED']
+
+#columns of the results dataframe used to build the fleet summary
+SUMMARY_COLUMNS = ['VIN', 'MAKE', 'MODEL', 'NHTSA MAKE', 'NHTSA MODEL', 'VEHICLE TYPE']
+
+#fleet summaries of recently processed results, keyed by a fingerprint of the summary columns, at most
+#SUMMARY_CACHE_SIZE summaries are kept, the cache is shared by every Streamlit session and background job thread
+#and the lock serializes access to it
+_summary_cache = {}
+_summary_cache_lock = threading.Lock()
+SUMMARY_CACHE_SIZE = 32
+
+#group vehicles by type for the fleet summary, returns a series holding the number of vehicles of each make/model,
+#with trailers, lifts and unconfirmed vehicles counted at the end, and a dataframe holding the VIN, make and model
+#recorded in the MCF deployment template for the unconfirmed vehicles
+def summarize_fleet(dataframe):
+    #treat missing values as empty strings
+    dataframe = dataframe[SUMMARY_COLUMNS].fillna('')
+    vehicle_type = dataframe['VEHICLE TYPE']
+    
+    #label every vehicle with the NHTSA MAKE and NHTSA MODEL returned from the NHTSA API, only for vehicles that are not lifts, trailers or unknown
+    #and have a make and model recorded, if the VIN relates to a trailer or lift, label it TRAILER or LIFT, otherwise label it UNCONFIRMED
+    labels = pd.Series(np.select([~vehicle_type.isin(['LIFT', 'TRAILER', 'UNKNOWN']) & (dataframe['NHTSA MAKE'] != '') & (dataframe['NHTSA MODEL'] != ''),
+                                  vehicle_type == 'TRAILER',
+                                  vehicle_type == 'LIFT'],
+                                 [dataframe['NHTSA MAKE'] + ' ' + dataframe['NHTSA MODEL'], 'TRAILER', 'LIFT'], 'UNCONFIRMED'),
+                       index = dataframe.index)
+    
+    #count the number of vehicles of each make and model, known vehicles sorted alphabetically first, then
+    #trailers, lifts and unconfirmed vehicles
+    counts = labels.value_counts()
+    bulk = counts.index.isin(BULK_VEHICLES)
+    counts = pd.concat([counts[~bulk].sort_index(), counts[bulk].sort_index()])
+    
+    #record the VIN and make/model information of the unconfirmed vehicles as recorded by the account manager in the MCF deployment template
+    unconfirmed = dataframe.loc[labels == 'UNCONFIRMED', ['VIN', 'MAKE', 'MODEL']].reset_index(drop = True)
+    return counts, unconfirmed
+
+#format the structured fleet summary as text, returns the known vehicle output and the unknown vehicle output
+def format_fleet_summary(counts, unconfirmed):
+    #write the vehicle counts to known_output text, known vehicles are sorted alphabetically and followed by the sorted lift, trailer and unconfirmed vehicles
+    bulk = counts.index.isin(BULK_VEHICLES)
+    known_output = ''.join(sorted(f'{key}: {value} \n' for key, value in counts[~bulk].items()))
+    known_output += ''.join(sorted(f'{key}: {value}\n' for key, value in counts[bulk].items()))
+    
+    #create empty unknown output text
+    unknown_output = ''
+    
+    #if there are any unconfirmed vehicles, add the related vehicle information to the unknown_output text
+    if len(unconfirmed) > 0:
+        #if any VIN is longer than 27 digits (which is a typo) add '...' to indicate the VIN is cut off
+        vins = 'VIN: ' + unconfirmed['VIN']
+        vins = vins.where(vins.str.len() <= 27, vins + '...')
+        #adjust the length of all the VINs to the length of the longest VIN to ensure spacing is consistent and output is formatted nicely,
+        #each vehicle is numbered, ex. first vehicle will say Vehicle 1 in the unknown vehicle output
+        length = vins.str.len().max()
+        unknown_output = '\n'.join(f'VEHICLE {i} INFO:    {vin.ljust(length)}    MAKE/MODEL: {make} {model}'
+                                   for i, (vin, make, model) in enumerate(zip(vins, unconfirmed['MAKE'], unconfirmed['MODEL']), start = 1))
+    
+    return known_output, unknown_output
+
+#create the fleet summary text, this will be called later within the 'confirm_vin()' function, summaries are cached by a fingerprint of the
+#summary columns so repeated calls with the same results skip the work
+def grouped_vehicles(dataframe):
+    #hash the summary columns row by row in a single vectorized pass, far cheaper than hashing the whole dataframe
+    key = pd.util.hash_pandas_object(dataframe[SUMMARY_COLUMNS].fillna(''), index = False).values.tobytes()
+    with _summary_cache_lock:
+        summary = _summary_cache.get(key)
+    #build the summary outside the lock so other threads are not held up by it
+    if summary is None:
+        summary = format_fleet_summary(*summarize_fleet(dataframe))
+        with _summary_cache_lock:
+            #forget the oldest summary once the cache is full
+            if key not in _summary_cache and len(_summary_cache) >= SUMMARY_CACHE_SIZE:
+                _summary_cache.pop(next(iter(_summary_cache)))
+            _summary_cache[key] = summary
+    return summary
+    
+
+#NHTSA endpoints used to decode VINs, DecodeVin decodes a single VIN per request while DecodeVINValuesBatch
+#decodes up to 50 VINs in a single request
+DECODE_VIN_URL = 'https://vpic.nhtsa.dot.gov/api/vehicles/DecodeVin/'
+DECODE_BATCH_URL = 'https://vpic.nhtsa.dot.gov/api/vehicles/DecodeVINValuesBatch/'
+
+#maximum number of VINs NHTSA accepts in a single DecodeVINValuesBatch request
+BATCH_SIZE = 50
+
+#DecodeVINValuesBatch returns flat field names, map them to the DecodeVin variable names used to build the results
+BATCH_FIELDS = {'ModelYear': 'Model Year', 'Make': 'Make', 'Model': 'Model',
+                'FuelTypePrimary': 'Fuel Type - Primary', 'VehicleType': 'Vehicle Type',
+                'ErrorText': 'Error Text'}
+
+#the decoded variables used to build the results, only these are kept in the VIN cache and checkpoints
+DECODED_FIELDS = list(BATCH_FIELDS.values())
+
+#keep only the decoded variables used to build the results, None marks a VIN with no information found
+def compact_decoded(decoded_values):
+    if decoded_values is None:
+        return None
+    return {name: decoded_values[name] for name in DECODED_FIELDS if name in decoded_values}
+
+#number of NHTSA requests allowed in flight at the same time, kept small to stay polite to NHTSA
+MAX_WORKERS = 4
+
+#seconds to wait for NHTSA to accept the connection and to send a response before the request times out
+REQUEST_TIMEOUT = (5, 30)
+
+#throttled (429) and server error (5xx) responses are retried up to MAX_RETRIES times, waiting a random amount
+#of time up to BACKOFF * 2^attempt seconds between attempts
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+BACKOFF = 1.0
+
+#priorities of NHTSA requests, requests of small uploads someone is waiting on are sent before requests of bulk
+#uploads whenever both are waiting on the rate limiter
+INTERACTIVE, BULK = 0, 1
+
+#uploads needing at most this many VINs from NHTSA are interactive, larger uploads are bulk
+SMALL_UPLOAD_VINS = 200
+
+#requests per second sent to NHTSA by this process across every upload and session, and the number of requests
+#that can be sent at once after a quiet period, set AUTOVIN_RATE_LIMIT=0 to turn the rate limit off
+RATE_LIMIT = float(os.environ.get('AUTOVIN_RATE_LIMIT', '10'))
+RATE_BURST = 10
+
+#token bucket shared by every NHTSA request of this process, a request takes a token before it is sent and waits for
+#one when the bucket is empty, a waiting request is only given a token once no request of a higher priority is waiting
+class RateLimiter:
+    def __init__(self, rate = RATE_LIMIT, burst = RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._waiting = Counter()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(float(self.burst), self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    #wait for a token, returns the seconds spent waiting
+    def acquire(self, priority = INTERACTIVE):
+        if not self.rate:
+            return 0.0
+        start = time.monotonic()
+        with self._condition:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    self._refill()
+                    urgent = any(self._waiting[other] for other in self._waiting if other < priority)
+                    if self._tokens >= 1 and not urgent:
+                        self._tokens -= 1
+                        return time.monotonic() - start
+                    #wait until the next token is due, or until woken by a request of a higher priority leaving
+                    self._condition.wait(max((1 - self._tokens) / self.rate, 0.01))
+            finally:
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+
+    #NHTSA throttled a request, empty the bucket so every upload slows down rather than only the throttled one
+    def throttled(self):
+        with self._condition:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0)
+
+#the rate limiter shared by every NHTSA request of this process
+RATE_LIMITER = RateLimiter()
+
+#connections to NHTSA kept open by this process, every upload sends up to max_workers requests at the same time
+#and several uploads run at once (vin_jobs runs JOB_WORKERS uploads), a request finding no free connection opens a
+#new one that is closed afterwards, set AUTOVIN_POOL_SIZE to keep more connections open, a lookup sending more
+#requests at once than the pool holds grows the pool to its own number of workers
+POOL_SIZE = int(os.environ.get('AUTOVIN_POOL_SIZE', str(4 * MAX_WORKERS)))
+
+#a single session is shared by every lookup so connections to NHTSA are pooled and kept alive between requests
+_session = None
+_session_lock = threading.Lock()
+
+#mount a connection pool of POOL_SIZE connections on the shared session
+def _mount_pool(session):
+    adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+#return the shared NHTSA session, creating it on first use
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _mount_pool(_session)
+        return _session
+
+#grow the connection pool of the shared session to at least size connections, connections of the previous pool
+#are closed once their requests finish
+def reserve_connections(size):
+    global POOL_SIZE
+    with _session_lock:
+        if size <= POOL_SIZE:
+            return
+        POOL_SIZE = size
+        if _session is not None:
+            _mount_pool(_session)
+
+#send a request to NHTSA through the shared session, throttled, failed and timed out requests are retried with
+#jittered backoff, an HTTPError is raised if the last response is still an error once retries run out and a timeout
+#is raised if every attempt timed out, so an NHTSA outage stops processing early instead of being read as VINs with
+#no information found, every attempt waits its turn with the process-wide rate limiter at the given priority
+def nhtsa_request(method, url, priority = INTERACTIVE, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        #NHTSA may tell us how long to wait before retrying with the Retry-After header
+        retry_after = ''
+        vin_metrics.count('rate_limit_wait_seconds', RATE_LIMITER.acquire(priority))
+        start = time.perf_counter()
+        try:
+            #bypasses certification verification error created by Michelin firewalls
+            response = get_session().request(method, url, timeout = REQUEST_TIMEOUT, verify = False, **kwargs)
+        except requests.exceptions.Timeout:
+            vin_metrics.request(time.perf_counter() - start, 'timeout', attempt)
+            if attempt == MAX_RETRIES:
+                raise
+        else:
+            vin_metrics.request(time.perf_counter() - start, response.status_code, attempt)
+            if response.status_code == 429:
+                RATE_LIMITER.throttled()
+            if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                response.raise_for_status()
+                return response
+            retry_after = response.headers.get('Retry-After', '')
+        #wait a random amount of time before the next attempt so parallel workers do not retry in lockstep
+        delay = random.uniform(0, BACKOFF * 2 ** attempt)
+        if retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        time.sleep(delay)
+
+#query the NHTSA DecodeVin endpoint for a single VIN, returns a dictionary of the decoded variables or None if
+#no information was found for the VIN
+def decode_vin(value, priority = INTERACTIVE):
+    #create VIN specific link to access details for API query
+    url = DECODE_VIN_URL + value + '?format=json'
+    #pulls details from url
+    response = nhtsa_request('GET', url, priority = priority)
+    try:
+        #save url information as data variable for query
+        data = response.json()
+    #NHTSA answered with an empty response, no information found for the VIN
+    except json.JSONDecodeError:
+        return None
+    #create key for decoding desired information from url data
+    return {item['Variable']: item['Value'] for item in data['Results']}
+
+#query the NHTSA DecodeVINValuesBatch endpoint for a list of at most BATCH_SIZE VINs, returns a list of decoded
+#dictionaries in the same order as the input VINs, None marks a VIN with no information found, HTTP errors are
+#raised so a failing NHTSA is not sent one request per VIN on top of the failed batch
+def decode_vin_batch(values, priority = INTERACTIVE):
+    #VINs are packed into a single ';' separated string, empty VINs or VINs containing the separators would shift
+    #the results out of line with the input, these VINs are decoded one at a time
+    packed = [value for value in values if value != '' and ';' not in value and ',' not in value]
+    decoded = {}
+    if packed:
+        #post every packable VIN in the batch in a single request
+        response = nhtsa_request('POST', DECODE_BATCH_URL, priority = priority, data = {'format': 'json', 'data': ';'.join(packed)})
+        try:
+            data = response.json()['Results']
+        #the batch response cannot be read, decode one VIN at a time so only the bad VINs are recorded as errors
+        except (json.JSONDecodeError, KeyError, TypeError):
+            data = []
+        #every result names the VIN it decodes, results are matched to the input by VIN, or by position if NHTSA
+        #returned one result per VIN without naming them, VINs that cannot be lined up are decoded one at a time
+        by_vin = {cache_key(item.get('VIN') or ''): item for item in data if isinstance(item, dict)}
+        if all(cache_key(value) in by_vin for value in packed):
+            items = [by_vin[cache_key(value)] for value in packed]
+        elif len(data) == len(packed):
+            items = data
+        else:
+            items = [by_vin.get(cache_key(value)) for value in packed]
+        #rename the flat batch fields, empty values are returned as None to match the DecodeVin output
+        decoded = {value: {name: item.get(field) or None for field, name in BATCH_FIELDS.items()}
+                   for value, item in zip(packed, items) if item is not None}
+    return [decoded[value] if value in decoded else decode_vin(value, priority) for value in values]
+
+#decode a list of VINs, results are returned in the same order as the input VINs, batch mode packs up to
+#BATCH_SIZE VINs into each request while single mode sends one request per VIN, at most max_workers requests
+#are sent to NHTSA at the same time, the requests are recorded in the run of the calling thread and sent at the
+#given priority
+def decode_vins(values, batch = True, max_workers = MAX_WORKERS, priority = INTERACTIVE):
+    vin_metrics.count('api_vins', len(values))
+    reserve_connections(max_workers)
+    with ThreadPoolExecutor(max_workers = max(1, max_workers)) as executor:
+        if not batch:
+            #executor.map returns results in input order, keeping the decoded VINs in line with the rows
+            return list(executor.map(vin_metrics.bind(partial(decode_vin, priority = priority)), values))
+        batches = [values[start:start + BATCH_SIZE] for start in range(0, len(values), BATCH_SIZE)]
+        return [decoded_values for batch_values in executor.map(vin_metrics.bind(partial(decode_vin_batch, priority = priority)), batches)
+                for decoded_values in batch_values]
+
+#VINs being fetched from NHTSA by any upload of this process, an upload needing a VIN another upload is already
+#fetching waits for that fetch instead of sending its own request
+class InFlight:
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    #claim the VINs this upload is to fetch, returns the VINs claimed and the futures of the VINs other uploads are
+    #already fetching by cache key
+    def claim(self, values):
+        claimed = []
+        shared = {}
+        with self._lock:
+            for value in values:
+                key = cache_key(value)
+                if key in self._futures:
+                    shared[key] = self._futures[key]
+                else:
+                    self._futures[key] = Future()
+                    claimed.append(value)
+        return claimed, shared
+
+    #hand the decoded values of claimed VINs to every upload waiting on them, or the error that stopped the fetch
+    def release(self, values, decoded = None, error = None):
+        with self._lock:
+            futures = [self._futures.pop(cache_key(value)) for value in values]
+        for future, decoded_values in zip(futures, decoded or [None] * len(futures)):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(decoded_values)
+
+#the VINs in flight across every upload of this process
+IN_FLIGHT = InFlight()
+
+#location of the persistent VIN cache, stored next to the application so it is shared across uploads and sessions
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vin_cache.sqlite3')
+
+#number of seconds a cached decode is trusted before NHTSA is queried again (30 days)
+CACHE_TTL = 30 * 24 * 60 * 60
+
+#maximum number of VINs kept in the cache, the least recently used VINs are removed once the cache is full
+CACHE_MAX_ENTRIES = 200000
+
+#normalize a VIN for use as a cache key, NHTSA decodes VINs regardless of case or surrounding whitespace
+def cache_key(value):
+    return str(value).strip().upper()
+
+#persistent SQLite cache of decoded VINs, the VINs found and missed are counted in the run diagnostics
+class VinCache:
+    def __init__(self, path = CACHE_PATH, ttl = CACHE_TTL, max_entries = CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        #the connection is shared by every Streamlit session thread, the lock serializes access to it
+        self._lock = threading.Lock()
+        #several processes may share the cache file, wait for the other processes' writes instead of failing
+        self._conn = sqlite3.connect(path, check_same_thread = False, timeout = 30)
+        #stored is when the VIN was decoded and is used for the TTL, used is when the VIN was last read and is
+        #used to decide which VINs to evict
+        self._conn.execute('CREATE TABLE IF NOT EXISTS vin_cache (vin TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                           'stored REAL NOT NULL, used REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS vin_cache_used ON vin_cache (used)')
+        self._conn.commit()
+
+    #return a dictionary of cache key to decoded values for every VIN found in the cache and not expired
+    def get_many(self, values):
+        keys = list(dict.fromkeys(cache_key(value) for value in values))
+        now = time.time()
+        found = {}
+        with self._lock:
+            #query in chunks to stay below the SQLite limit on the number of query parameters
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute('SELECT vin, data FROM vin_cache WHERE stored > ? AND vin IN ({})'.format(','.join('?' * len(chunk))),
+                                          [now - self.ttl] + chunk).fetchall()
+                found.update((vin, json.loads(data)) for vin, data in rows)
+            #mark the found VINs as recently used so they are the last to be evicted
+            self._conn.executemany('UPDATE vin_cache SET used = ? WHERE vin = ?', [(now, vin) for vin in found])
+            self._conn.commit()
+        return found
+
+    #store decoded values in the cache, decoded is a dictionary of VIN to decoded values, only the fields used to
+    #build the results are kept
+    def put_many(self, decoded):
+        now = time.time()
+        rows = [(cache_key(value), json.dumps(compact_decoded(values)), now, now)
+                for value, values in decoded.items()]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO vin_cache (vin, data, stored, used) VALUES (?, ?, ?, ?)', rows)
+            #remove expired VINs, then remove the least recently used VINs until the cache fits in max_entries
+            self._conn.execute('DELETE FROM vin_cache WHERE stored <= ?', (now - self.ttl,))
+            overflow = self._conn.execute('SELECT COUNT(*) FROM vin_cache').fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self._conn.execute('DELETE FROM vin_cache WHERE vin IN (SELECT vin FROM vin_cache ORDER BY used LIMIT ?)', (overflow,))
+            self._conn.commit()
+
+#the VIN cache shared by every upload in this process, created on first use
+_cache = None
+_cache_lock = threading.Lock()
+
+#return the shared VIN cache, creating it on first use
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = VinCache()
+        return _cache
+
+#ISO 3779 transliteration of VIN characters to numbers and the weight of each VIN position, used to compute the
+#check digit in position 9, the letters I, O and Q are never used in a VIN
+VIN_TRANSLITERATION = dict(zip('0123456789ABCDEFGHJKLMNPRSTUVWXYZ',
+                               [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 1, 2, 3, 4, 5, 6, 7, 8, 1, 2, 3, 4, 5, 7, 9, 2, 3, 4, 5, 6, 7, 8, 9]))
+VIN_WEIGHTS = [8, 7, 6, 5, 4, 3, 2, 10, 0, 9, 8, 7, 6, 5, 4, 3, 2]
+
+#model year codes in position 10, the codes repeat every 30 years starting from 1980
+YEAR_CODES = 'ABCDEFGHJKLMNPRSTVWXY123456789'
+
+#compute the check digit of a 17 character VIN, returns None if the VIN contains characters a VIN cannot contain
+def check_digit(value):
+    try:
+        total = sum(VIN_TRANSLITERATION[char] * weight for char, weight in zip(value.upper(), VIN_WEIGHTS))
+    except KeyError:
+        return None
+    return 'X' if total % 11 == 10 else str(total % 11)
+
+#common data entry errors corrected before a VIN is decoded, each entry holds the pattern replaced, its
+#replacement, the text recorded in the 'VIN CORRECTED' column and a word that stops the correction when the VIN
+#contains it, corrections are applied in this order, every kind of whitespace is removed as VINs pasted from other
+#documents often carry tabs, line breaks or non-breaking spaces
+VIN_CORRECTIONS = [(r'\s', '', 'Spaces Removed', None),
+                   ('[Qq]', '0', "Replaced 'Q' with '0'", None),
+                   ('[Oo]', '0', "Replaced 'O' with '0'", 'unknown'),
+                   ('[Ii]', '1', "Replaced 'I' with 1", None)]
+
+#lookup table used to compute check digits for a whole column of VINs at once, maps ASCII codes to the
+#transliterated value of the character
+_TRANSLITERATION_TABLE = np.zeros(128, dtype = np.int64)
+for char, number in VIN_TRANSLITERATION.items():
+    _TRANSLITERATION_TABLE[ord(char)] = number
+
+#correct common data entry errors across a whole column of VINs and flag VINs that cannot be valid, returns a
+#dataframe with the corrected 'VIN', the 'VIN CORRECTED' text listing every correction applied, a 'VIN ERROR'
+#message for VINs that should not be sent to NHTSA (None for the rest) and a 'CHECK DIGIT VALID' flag
+def normalize_vins(vins):
+    vins = vins.astype(str)
+    applied = pd.Series('', index = vins.index)
+    for pattern, replacement, label, exception in VIN_CORRECTIONS:
+        matches = vins.str.contains(pattern)
+        if exception is not None:
+            matches &= ~vins.str.lower().str.contains(exception, regex = False)
+        vins = vins.where(~matches, vins.str.replace(pattern, replacement, regex = True))
+        applied = applied.where(~matches, applied + ', ' + label)
+    normalized = pd.DataFrame({'VIN': vins,
+                               'VIN CORRECTED': np.where(applied == '', 'NO', 'YES: ' + applied.str[2:])})
+    
+    #flag VINs that cannot be valid, placeholders, VINs that are not 17 characters long and VINs containing
+    #characters a VIN cannot contain are never sent to NHTSA
+    upper = vins.str.upper()
+    placeholder = upper.str.contains('EXAMPLE|UNKNOWN')
+    wrong_length = upper.str.len() != 17
+    invalid_characters = ~upper.str.fullmatch('[A-HJ-NPR-Z0-9]*')
+    normalized['VIN ERROR'] = np.select([placeholder, wrong_length, invalid_characters],
+                                        ['Error: Placeholder VIN', 'Error: VIN must be 17 characters long',
+                                         'Error: VIN contains characters that are not allowed in a VIN'], None)
+    
+    #compute the position 9 check digit of every well formed VIN at once, other VINs are marked as invalid
+    normalized['CHECK DIGIT VALID'] = False
+    well_formed = ~wrong_length & ~invalid_characters
+    if well_formed.any():
+        codes = np.frombuffer(''.join(upper[well_formed]).encode('ascii'), dtype = np.uint8).reshape(-1, 17)
+        totals = (_TRANSLITERATION_TABLE[codes] * VIN_WEIGHTS).sum(axis = 1) % 11
+        expected = np.where(totals == 10, ord('X'), totals + ord('0'))
+        normalized.loc[well_formed, 'CHECK DIGIT VALID'] = expected == codes[:, 8]
+    return normalized
+
+#location of the local vPIC extract used by the offline decoder, the offline decoder is only used if this file exists
+OFFLINE_DB_PATH = os.environ.get('AUTOVIN_VPIC_EXTRACT', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vpic_extract.sqlite3'))
+
+#error text NHTSA returns for a VIN that decodes cleanly, the offline decoder only answers for VINs like these
+CLEAN_DECODE_TEXT = '0 - VIN decoded clean. Check Digit (9th position) is correct'
+
+#convert a vPIC pattern key to a regular expression, '*' matches any character and [...] matches a set of characters
+def _pattern_regex(keys):
+    return ''.join('.' if part == '*' else part if part.startswith('[') else re.escape(part)
+                   for part in re.findall(r'\[[^\]]*\]|.', keys))
+
+#decode VINs locally from an extract of the NHTSA vPIC standalone database, the extract is a SQLite file with two
+#tables built from the vPIC Wmi, Make, VehicleType, Wmi_VinSchema, Pattern and Element tables:
+#   wmi(wmi, make, vehicle_type)
+#   pattern(wmi, year_from, year_to, keys, model, fuel_type)
+#values are stored as DecodeVin returns them, keys are vPIC pattern keys over VIN positions 4-8 optionally
+#followed by '|' and a key over positions 10-17, a missing year_to means the pattern is still in use, vin_extract
+#builds the extract
+class OfflineDecoder:
+    def __init__(self, wmis, patterns):
+        #index WMIs by code for constant time lookup, each WMI holds its make, vehicle type and compiled patterns
+        self.index = {wmi: (make, vehicle_type, []) for wmi, make, vehicle_type in wmis}
+        for wmi, year_from, year_to, keys, model, fuel_type in patterns:
+            if wmi in self.index:
+                vds, _, vis = keys.partition('|')
+                #keys shorter than their VIN positions match from the start of those positions
+                regex = re.compile(_pattern_regex(vds) + r'[^|]*\|' + _pattern_regex(vis))
+                self.index[wmi][2].append((int(year_from or 0), int(year_to or 9999), regex, model, fuel_type))
+
+    #load the offline decoder from a vPIC extract
+    @classmethod
+    def from_sqlite(cls, path):
+        with sqlite3.connect(path) as conn:
+            wmis = conn.execute('SELECT wmi, make, vehicle_type FROM wmi').fetchall()
+            patterns = conn.execute('SELECT wmi, year_from, year_to, keys, model, fuel_type FROM pattern').fetchall()
+        return cls(wmis, patterns)
+
+    #decode a single VIN, returns the decoded values in the same form as decode_vin or None if the VIN cannot be
+    #decoded locally without ambiguity, in which case NHTSA should be queried
+    def decode(self, value):
+        value = value.upper()
+        #only VINs with a correct check digit are decoded locally, NHTSA reports the errors for the rest
+        if len(value) != 17 or check_digit(value) != value[8]:
+            return None
+        #manufacturers building fewer than 1000 vehicles a year share a WMI ending in 9, positions 12-14 complete it
+        wmi = value[:3] + value[11:14] if value[2] == '9' and value[:3] + value[11:14] in self.index else value[:3]
+        if wmi not in self.index or value[9] not in YEAR_CODES:
+            return None
+        make, vehicle_type, patterns = self.index[wmi]
+        #the year code repeats every 30 years, keep both possible years unless the year lies in the future
+        base_year = 1980 + YEAR_CODES.index(value[9])
+        years = [year for year in (base_year, base_year + 30) if year <= datetime.now().year + 1]
+        target = value[3:8] + '|' + value[9:]
+        matches = {(year, model, fuel_type) for year_from, year_to, regex, model, fuel_type in patterns
+                   if regex.match(target) for year in years if year_from <= year <= year_to}
+        #no match or several different matches, the VIN is ambiguous locally
+        if len(matches) != 1:
+            return None
+        year, model, fuel_type = matches.pop()
+        return {'Model Year': str(year), 'Make': make, 'Model': model, 'Fuel Type - Primary': fuel_type,
+                'Vehicle Type': vehicle_type, 'Error Text': CLEAN_DECODE_TEXT}
+
+#the offline decoder shared by every upload in this process, False marks that no vPIC extract is available
+_offline_decoder = None
+_offline_lock = threading.Lock()
+
+#return the shared offline decoder, loading the vPIC extract on first use, returns None if there is no extract
+def get_offline_decoder():
+    global _offline_decoder
+    with _offline_lock:
+        if _offline_decoder is None:
+            _offline_decoder = OfflineDecoder.from_sqlite(OFFLINE_DB_PATH) if os.path.exists(OFFLINE_DB_PATH) else False
+        return _offline_decoder or None
+
+#decode a list of VINs, checking the cache and the offline decoder before going to the network, results are returned
+#in the same order as the input VINs, each distinct VIN is only sent to NHTSA once, and VINs another upload is
+#fetching at the same time are taken from that fetch
+def lookup_vins(values, batch = True, max_workers = MAX_WORKERS, cache = None, offline = None, priority = INTERACTIVE):
+    found = cache.get_many(values) if cache is not None else {}
+    if cache is not None:
+        vin_metrics.count('vin_cache_hits', len(found))
+        vin_metrics.count('vin_cache_misses', len(set(map(cache_key, values))) - len(found))
+    #decode the VINs missing from the cache locally, only VINs the offline decoder cannot decode are sent to NHTSA
+    if offline is not None:
+        cached = len(found)
+        for value in values:
+            if cache_key(value) not in found:
+                decoded_values = offline.decode(value)
+                if decoded_values is not None:
+                    found[cache_key(value)] = decoded_values
+        vin_metrics.count('offline_hits', len(found) - cached)
+    #collect the VINs still missing, one VIN per cache key
+    missing = list({cache_key(value): value for value in values if cache_key(value) not in found}.values())
+    missing, shared = IN_FLIGHT.claim(missing)
+    vin_metrics.count('coalesced_vins', len(shared))
+    try:
+        fetched = decode_vins(missing, batch = batch, max_workers = max_workers, priority = priority)
+    except BaseException as e:
+        IN_FLIGHT.release(missing, error = e)
+        raise
+    #store the VINs NHTSA found information for before handing them to other uploads, VINs with no information
+    #are queried again on the next upload
+    try:
+        if cache is not None:
+            cache.put_many({value: decoded_values for value, decoded_values in zip(missing, fetched) if decoded_values is not None})
+    finally:
+        IN_FLIGHT.release(missing, fetched)
+    found.update((cache_key(value), decoded_values) for value, decoded_values in zip(missing, fetched))
+    #wait for the VINs other uploads are fetching, an error stopping their fetch stops this lookup too
+    found.update((key, future.result()) for key, future in shared.items())
+    return [found[cache_key(value)] for value in values]
+
+#characters commonly confused with each other when VINs are copied by hand, used to suggest corrections of VINs
+#that could not be decoded
+CONFUSED_CHARACTERS = {'S': '5', '5': 'S', 'B': '8', '8': 'B', 'Z': '2', '2': 'Z', 'G': '6', '6': 'G'}
+
+#maximum number of candidate corrections of a single VIN verified with NHTSA, the most likely candidates are kept
+MAX_CANDIDATES = 5
+
+#return the model year recorded in the template as a whole number, None if no year was recorded
+def template_year(value):
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+#return the candidate corrections of a 17 character VIN ranked most likely first, single substitutions of commonly
+#confused characters are ranked before swaps of neighbouring characters, each entry holds the candidate VIN and a
+#description of the change, candidates whose check digit does not compute or whose model year code cannot be the
+#year recorded in the template are pruned without sending them to NHTSA
+def correction_candidates(value, year = None):
+    value = value.upper()
+    candidates = []
+    for position, char in enumerate(value):
+        if char in CONFUSED_CHARACTERS:
+            candidates.append((value[:position] + CONFUSED_CHARACTERS[char] + value[position + 1:],
+                               f"Replaced '{char}' with '{CONFUSED_CHARACTERS[char]}' at position {position + 1}"))
+    for position in range(16):
+        if value[position] != value[position + 1]:
+            candidates.append((value[:position] + value[position + 1] + value[position] + value[position + 2:],
+                               f'Swapped positions {position + 1} and {position + 2}'))
+    #the model year codes repeat every 30 years starting from 1980
+    return [(candidate, description) for candidate, description in candidates
+            if check_digit(candidate) == candidate[8] and candidate[9] in YEAR_CODES
+            and (year is None or (year - 1980) % 30 == YEAR_CODES.index(candidate[9]))]
+
+#check a decoded candidate against the make and model year recorded in the template, makes are compared ignoring
+#case and punctuation and agree if one contains the other or they share their first 4 characters ('Chevy' and
+#'CHEVROLET'), fields left empty in the template are not compared
+def matches_template(decoded_values, make, year):
+    decoded_make = re.sub('[^0-9A-Z]', '', str(decoded_values.get('Make') or '').upper())
+    make = re.sub('[^0-9A-Z]', '', make.upper())
+    if make and not (decoded_make and (make in decoded_make or decoded_make in make or
+                                       (len(make) >= 4 and make[:4] == decoded_make[:4]))):
+        return False
+    return year is None or template_year(decoded_values.get('Model Year') or '') == year
+
+#suggest corrections for the VINs of vin_data NHTSA found no information for or whose check digit does not compute,
+#DecodeVINValuesBatch answers a VIN it cannot decode with an error row rather than no information so a VIN decoded
+#without a make counts as one NHTSA found no information for, the candidates of every such VIN are verified together
+#in batched NHTSA requests and a candidate is only suggested when it decodes to the make and model year recorded in
+#the template, VINs without a make or year in the template are not corrected, returns the suggestion of every row
+#(None for rows without one) lined up with the rows of vin_data
+def suggest_corrections(vin_data, normalized, decoded, **lookup_options):
+    suggestions = [None] * len(vin_data)
+    candidates = {}
+    for row, (value, vin_error, check_digit_valid, make, year) in enumerate(zip(
+            normalized['VIN'], normalized['VIN ERROR'], normalized['CHECK DIGIT VALID'], vin_data['MAKE'], vin_data['YEAR'])):
+        #VINs not decoded because processing stopped early are not corrected
+        if vin_error is not None or cache_key(value) not in decoded:
+            continue
+        decoded_values = decoded[cache_key(value)]
+        if decoded_values is not None and decoded_values.get('Make') and check_digit_valid:
+            continue
+        if make.strip() == '' and template_year(year) is None:
+            continue
+        candidates[row] = correction_candidates(value, template_year(year))[:MAX_CANDIDATES]
+    values = [candidate for row_candidates in candidates.values() for candidate, description in row_candidates]
+    if not values:
+        return suggestions
+    #suggestions are extra information, a failed verification leaves the VINs without suggestions
+    try:
+        verified = dict(zip(map(cache_key, values), lookup_vins(values, **lookup_options)))
+    except Exception:
+        return suggestions
+    for row, row_candidates in candidates.items():
+        make, year = vin_data['MAKE'].iat[row], template_year(vin_data['YEAR'].iat[row])
+        for candidate, description in row_candidates:
+            decoded_values = verified[cache_key(candidate)]
+            if decoded_values is not None and matches_template(decoded_values, make, year):
+                suggestions[row] = f"{candidate}: {description}, decodes as {decoded_values.get('Make')} {decoded_values.get('Model Year')}"
+                break
+    vin_metrics.count('vin_suggestions', sum(suggestion is not None for suggestion in suggestions))
+    return suggestions
+
+#the sheet holding the VINs in workbooks with more than 1 sheet, this is the standard naming convention of the
+#MCF deployment template
+TEMPLATE_SHEET = 'Vehicle & Asset List'
+
+#the column headers are on the 4th row of the MCF deployment template
+HEADER_ROW = 3
+
+#the columns confirm_vin needs, each entry holds the text identifying the column in the template header and the
+#standard name of the column, headers are matched against the entries in this order
+TEMPLATE_COLUMNS = [('vehicle asset name', 'Vehicle Asset Name'), ('model year', 'Model Year'), ('make', 'Make'),
+                    ('model', 'Model'), ('vin', 'VIN'), ('fuel type', 'Fuel Type')]
+
+#return the standard name of a template column header, None for columns confirm_vin does not need
+def standard_column(header):
+    for text, name in TEMPLATE_COLUMNS:
+        if text in str(header).lower():
+            return name
+    return None
+
+#return the position of each needed column in a header row, only the first column matching a standard name is used
+def template_positions(header):
+    positions = {}
+    for position, column in enumerate(header):
+        name = standard_column(column) if column is not None else None
+        if name is not None and name not in positions:
+            positions[name] = position
+    if 'VIN' not in positions:
+        raise ValueError('No VIN column found, please check the uploaded document follows the MCF Deployment Template')
+    return positions
+
+#return the contents of an upload, the upload can be a file path or a file-like object such as a Streamlit upload
+def read_upload(upload):
+    if isinstance(upload, (bytes, bytearray)):
+        return bytes(upload)
+    if isinstance(upload, (str, os.PathLike)):
+        with open(upload, 'rb') as f:
+            return f.read()
+    return upload.getvalue() if hasattr(upload, 'getvalue') else upload.read()
+
+#work out the format of an uploaded file from its first bytes, xlsx files are zip archives and xls files are
+#OLE2 compound documents, anything else is read as CSV
+def sniff_format(data):
+    signature = data[:8]
+    if signature.startswith(b'PK\x03\x04'):
+        return 'xlsx'
+    if signature.startswith(b'\xd0\xcf\x11\xe0'):
+        return 'xls'
+    return 'csv'
+
+#open an xlsx template in read-only mode, returns the standard names of the needed columns and a generator reading
+#the values of the needed columns one row at a time, the workbook is closed once every row has been read
+def xlsx_rows(data):
+    wb = openpyxl.load_workbook(BytesIO(data), read_only = True, data_only = True)
+    #workbooks with more than 1 sheet hold the VINs in the 'Vehicle & Asset List' sheet
+    ws = wb[TEMPLATE_SHEET] if len(wb.sheetnames) > 1 else wb.worksheets[0]
+    #the dimensions saved in the file are not always correct, read every row the sheet holds
+    ws.reset_dimensions()
+    rows = ws.iter_rows(values_only = True)
+    for _ in range(HEADER_ROW):
+        next(rows, None)
+    try:
+        positions = template_positions(next(rows, ()))
+    except ValueError:
+        wb.close()
+        raise
+    def values():
+        try:
+            for row in rows:
+                yield [row[position] if position < len(row) else None for position in positions.values()]
+        finally:
+            wb.close()
+    return list(positions), values()
+
+#read the needed columns of an xlsx template, the workbook is opened once in read-only mode and only the values
+#of the needed columns are kept
+def read_xlsx(data):
+    columns, rows = xlsx_rows(data)
+    data = list(rows)
+    #drop the empty rows at the end of the sheet, templates are often formatted far below the last vehicle
+    while data and all(value is None for value in data[-1]):
+        data.pop()
+    return pd.DataFrame(data, columns = columns)
+
+#read the needed columns of an xls template
+def read_xls(data):
+    with pd.ExcelFile(BytesIO(data)) as xls:
+        sheet = TEMPLATE_SHEET if len(xls.sheet_names) > 1 else 0
+        raw_vin_data = xls.parse(sheet, header = HEADER_ROW, usecols = lambda column: standard_column(column) is not None)
+    positions = template_positions(raw_vin_data.columns)
+    return raw_vin_data.iloc[:, list(positions.values())].set_axis(list(positions), axis = 1)
+
+#find the header of a CSV file, the header is the first of the first rows naming a VIN column so both CSV exports
+#of the template and plain CSV files with the header on the first row can be read, returns the header row and the
+#position of each needed column
+def csv_layout(data):
+    with io.TextIOWrapper(BytesIO(data), newline = '', encoding = 'utf-8-sig', errors = 'replace') as f:
+        first_rows = [row for _, row in zip(range(HEADER_ROW + 1), csv.reader(f))]
+    header_row = next((i for i, row in enumerate(first_rows) if any(standard_column(cell) == 'VIN' for cell in row)), HEADER_ROW)
+    return header_row, template_positions(first_rows[header_row] if header_row < len(first_rows) else [])
+
+#read the needed columns of a CSV file, values are kept as text exactly as written, with chunk_rows set an iterator
+#of dataframes of at most chunk_rows rows is returned instead of a single dataframe
+def read_csv(data, chunk_rows = None):
+    header_row, positions = csv_layout(data)
+    raw_vin_data = pd.read_csv(BytesIO(data), skiprows = header_row, header = 0, usecols = list(positions.values()),
+                               dtype = str, encoding = 'utf-8-sig', encoding_errors = 'replace', chunksize = chunk_rows)
+    #positions are listed in file order, the same order read_csv returns the columns in
+    if chunk_rows is not None:
+        return (chunk.set_axis(list(positions), axis = 1) for chunk in raw_vin_data)
+    return raw_vin_data.set_axis(list(positions), axis = 1)
+
+#read the vehicles from the contents of an uploaded MCF deployment template in a single pass, returns a dataframe
+#holding the standard columns confirm_vin needs, columns missing from the template are left empty
+def read_template(data):
+    readers = {'xlsx': read_xlsx, 'xls': read_xls, 'csv': read_csv}
+    raw_vin_data = readers[sniff_format(data)](data)
+    for text, name in TEMPLATE_COLUMNS:
+        if name not in raw_vin_data.columns:
+            raw_vin_data[name] = np.nan
+    return raw_vin_data
+
+#number of rows of the template read and processed at a time in streaming mode
+STREAM_CHUNK_ROWS = 5000
+
+#work out the type pandas gives each column of an xlsx template, pandas decides the type of a column from every
+#row of the sheet and the type decides how numbers are written, a year column holding empty cells is read as
+#floats, one value of each type found in a column (with the smallest and largest whole numbers) decides the same
+#type as the whole column, empty rows at the end of the sheet are not counted
+def xlsx_dtypes(columns, rows):
+    samples = [{} for _ in columns]
+    has_empty = [False] * len(columns)
+    empty_rows = 0
+    for row in rows:
+        if all(value is None for value in row):
+            empty_rows += 1
+            continue
+        if empty_rows:
+            has_empty = [True] * len(columns)
+            empty_rows = 0
+        for position, value in enumerate(row):
+            if value is None:
+                has_empty[position] = True
+            elif isinstance(value, int) and not isinstance(value, bool):
+                low, high = samples[position].get('low', value), samples[position].get('high', value)
+                samples[position]['low'], samples[position]['high'] = min(low, value), max(high, value)
+            else:
+                samples[position].setdefault(type(value), value)
+    return {column: pd.DataFrame([[value] for value in list(sample.values()) + [None] * empty]).dtypes[0] if sample or empty else np.dtype(object)
+            for column, sample, empty in zip(columns, samples, has_empty)}
+
+#read the needed columns of an xlsx template one row at a time, returns dataframes of at most chunk_rows rows with
+#the column types read_xlsx would give them, the sheet is read twice, first to work out the column types
+def xlsx_chunks(data, chunk_rows = STREAM_CHUNK_ROWS):
+    dtypes = xlsx_dtypes(*xlsx_rows(data))
+    columns, rows = xlsx_rows(data)
+    chunk = []
+    for row in rows:
+        #empty rows hold no vehicle, they only matter to the column types
+        if all(value is None for value in row):
+            continue
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield pd.DataFrame(chunk, columns = columns, dtype = object).astype(dtypes)
+            chunk = []
+    if chunk:
+        yield pd.DataFrame(chunk, columns = columns, dtype = object).astype(dtypes)
+
+#read the vehicles of an uploaded MCF deployment template in dataframes of at most chunk_rows rows, every chunk
+#holds the same standard columns and values read_template returns for its rows, xlsx and csv templates are read
+#lazily while xls templates (at most 65536 rows) are read whole and split into chunks
+def template_chunks(data, chunk_rows = STREAM_CHUNK_ROWS):
+    file_format = sniff_format(data)
+    if file_format == 'xlsx':
+        chunks = xlsx_chunks(data, chunk_rows)
+    elif file_format == 'csv':
+        chunks = read_csv(data, chunk_rows)
+    else:
+        raw_vin_data = read_template(data)
+        chunks = (raw_vin_data.iloc[start:start + chunk_rows] for start in range(0, len(raw_vin_data), chunk_rows))
+    empty = True
+    for chunk in chunks:
+        for text, name in TEMPLATE_COLUMNS:
+            if name not in chunk.columns:
+                chunk[name] = np.nan
+        empty = False
+        yield chunk
+    #a template without vehicles still produces output files holding only their headers
+    if empty:
+        yield pd.DataFrame({name: pd.Series(dtype = object) for text, name in TEMPLATE_COLUMNS})
+
+#number of distinct VINs decoded between two checkpoints, one batch for every worker
+CHUNK_SIZE = BATCH_SIZE * MAX_WORKERS
+
+#location of the checkpoints of uploads being processed, each upload is checkpointed to a file named after a hash
+#of its contents so uploading the same file again resumes from its checkpoint
+CHECKPOINT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'checkpoints')
+
+#error text recorded for VINs that were not decoded because processing stopped early
+NOT_DECODED_TEXT = 'Error: VIN not decoded, processing stopped early. Upload the file again to resume'
+
+#error text recorded for VINs NHTSA found no information for
+NO_INFORMATION_TEXT = 'Error: No information found for input VIN'
+
+#return the checkpoint file of an upload from its contents
+def checkpoint_path(data):
+    digest = hashlib.sha256(data).hexdigest()
+    return os.path.join(CHECKPOINT_DIR, digest + '.jsonl')
+
+#read the VINs decoded so far from a checkpoint file, returns a dictionary of cache key to decoded values, the last
+#line may have been cut off by the interruption, the file is truncated to its last complete line so records
+#appended on resume start on a new line, the VIN of the cut off line is decoded again
+def load_checkpoint(path):
+    decoded = {}
+    if not os.path.exists(path):
+        return decoded
+    with open(path, 'rb+') as f:
+        complete = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            decoded[record['vin']] = record['decoded']
+            complete += len(line)
+        f.truncate(complete)
+    return decoded
+
+#decode a list of VINs in chunks of chunk_size distinct VINs, appending every decoded chunk to the checkpoint file
+#and reporting progress after each chunk, VINs already in the checkpoint are not decoded again, returns a
+#dictionary of cache key to decoded values and the error that stopped processing early (None if every VIN was
+#decoded), progress is called with the rows done, the total rows, the rows decoded per second and the seconds left
+def decode_in_chunks(values, checkpoint = None, progress = None, chunk_size = CHUNK_SIZE, **lookup_options):
+    decoded = load_checkpoint(checkpoint) if checkpoint is not None else {}
+    #count the rows of every distinct VIN so progress is reported in rows
+    rows = Counter(cache_key(value) for value in values)
+    pending = list({cache_key(value): value for value in values if cache_key(value) not in decoded}.values())
+    total = len(values)
+    done = resumed = total - sum(rows[cache_key(value)] for value in pending)
+    vin_metrics.count('checkpoint_rows', resumed)
+    start = time.time()
+    error = None
+    if progress is not None:
+        progress(done, total, 0.0, None)
+    if checkpoint is not None:
+        os.makedirs(os.path.dirname(checkpoint), exist_ok = True)
+    with open(checkpoint, 'a') if checkpoint is not None else open(os.devnull, 'w') as f:
+        for chunk_start in range(0, len(pending), chunk_size):
+            chunk = pending[chunk_start:chunk_start + chunk_size]
+            #stop on any error, the VINs decoded so far are kept so partial outputs can still be written
+            try:
+                chunk_decoded = lookup_vins(chunk, **lookup_options)
+            except Exception as e:
+                error = e
+                break
+            for value, decoded_values in zip(chunk, chunk_decoded):
+                decoded[cache_key(value)] = compact_decoded(decoded_values)
+                f.write(json.dumps({'vin': cache_key(value), 'decoded': decoded[cache_key(value)]}) + '\n')
+            f.flush()
+            #report rows done, decoding rate and estimated time left
+            done += sum(rows[cache_key(value)] for value in chunk)
+            if progress is not None:
+                rate = (done - resumed) / max(time.time() - start, 1e-9)
+                progress(done, total, rate, (total - done) / rate if rate else None)
+    return decoded, error
+
+#width of the 'ERROR CODE' column, the width of its title, error codes are too long to show in full
+ERROR_CODE_WIDTH = 12
+
+#style of the header row of the processed VINs sheet, matches the header pandas writes
+HEADER_FONT = Font(bold = True)
+HEADER_BORDER = Border(left = Side(style = 'thin'), right = Side(style = 'thin'), top = Side(style = 'thin'), bottom = Side(style = 'thin'))
+HEADER_ALIGNMENT = Alignment(horizontal = 'center', vertical = 'top')
+
+#size every column of the results to show all data, the width is the length of the longest value or title plus 2,
+#the lengths are computed for each column at once, widths holds the widths of earlier chunks of the same results
+def column_widths(results, widths = None):
+    widths = dict(widths or {})
+    for column in results.columns:
+        if column == 'ERROR CODE':
+            width = ERROR_CODE_WIDTH
+        else:
+            lengths = results[column].dropna().astype(str).str.len()
+            width = max(len(str(column)), lengths.max() if len(lengths) else 0) + 2
+        widths[column] = max(widths.get(column, 0), width)
+    return widths
+
+#return the rows of the results dataframe as tuples, empty values are returned as None
+def result_rows(results):
+    return results.astype(object).where(results.notna(), None).itertuples(index = False, name = None)
+
+#write a workbook with a single 'Processed VINs' sheet to target, a file path or a file-like object, the workbook
+#is streamed row by row with openpyxl's write-only mode so only the row being written is held in memory
+def write_processed_workbook(target, columns, widths, rows):
+    wb = openpyxl.Workbook(write_only = True)
+    ws = wb.create_sheet('Processed VINs')
+    for idx, column in enumerate(columns, start = 1):
+        ws.column_dimensions[get_column_letter(idx)].width = widths[column]
+    
+    #write the header row, then every row, empty values are written as empty cells
+    header = []
+    for column in columns:
+        cell = WriteOnlyCell(ws, value = column)
+        cell.font, cell.border, cell.alignment = HEADER_FONT, HEADER_BORDER, HEADER_ALIGNMENT
+        header.append(cell)
+    ws.append(header)
+    for row in rows:
+        ws.append(row)
+    wb.save(target)
+
+#write the results dataframe to an in-memory Excel workbook, returns the contents of the workbook
+def processed_workbook(results):
+    buffer = BytesIO()
+    write_processed_workbook(buffer, results.columns, column_widths(results), result_rows(results))
+    return buffer.getvalue()
+
+#return the decoded value of a variable for every row, rows with no information found are filled with 'Error'
+def decoded_column(decoded_rows, name):
+    return ['Error' if decoded_values is None else decoded_values.get(name, 'N/A') for decoded_values in decoded_rows]
+
+#write relevant info into vin_data dataframe using raw data from original sales document, only includes info from
+#rows where vin has been entered, excludes NULL/NAN values, the dataframe is built in one step in the standard
+#format required for the CAN compatability check
+def vehicle_rows(raw_vin_data):
+    vin_data = raw_vin_data.loc[raw_vin_data['VIN'].notna(), ['Vehicle Asset Name', 'VIN', 'Model Year', 'Make', 'Model', 'Fuel Type']]
+    vin_data = vin_data.set_axis(['VRN', 'VIN', 'YEAR', 'MAKE', 'MODEL', 'FUEL'], axis = 1).assign(COUNTRY = 'US')
+    
+    #reset the vin dataframe index, index now begins at 0
+    vin_data.reset_index(drop = True, inplace = True)
+    
+    #replace NAN/NULL values indicating empty cell with an empty string
+    vin_data.replace(np.nan, '', inplace = True)
+    
+    #change the values in vin_data dataframe to strings, this is necessary for later string concatenation
+    return vin_data.astype(str)
+
+#build the results of the vehicles in vin_data from their normalized VINs and the decoded VINs, returns the results
+#dataframe holding every VIN, the valid_vins dataframe in the format of the CAN compatability check and the number
+#of rows that were not decoded because processing stopped early, seen holds the VINs of earlier chunks of the same
+#upload when the upload is processed in chunks and is updated with the VINs of this chunk, suggestions holds the
+#suggested correction of every row (see suggest_corrections)
+def build_results(vin_data, normalized, decoded, seen = None, suggestions = None):
+    #line the decoded VINs up with the rows of vin_data, None marks a row with no information found, rows that
+    #cannot be valid or were not decoded because processing stopped early record the reason
+    decoded_rows = []
+    row_errors = []
+    for value, vin_error in zip(normalized['VIN'], normalized['VIN ERROR']):
+        if vin_error is None and cache_key(value) not in decoded:
+            vin_error = NOT_DECODED_TEXT
+        decoded_rows.append(decoded.get(cache_key(value)) if vin_error is None else None)
+        row_errors.append(vin_error)
+    
+    #count the rows that were not decoded, these are decoded when the file is uploaded again
+    pending = row_errors.count(NOT_DECODED_TEXT)
+    
+    #create the results dataframe in a single step, each row relates to a specific VIN, rows with no information
+    #found are filled with 'Error', as MCF operates in United States all entries for Country = US
+    results = pd.DataFrame({
+        'VRN': vin_data['VRN'],
+        'VIN': normalized['VIN'],
+        'VIN CORRECTED': normalized['VIN CORRECTED'],
+        'VIN SUGGESTION': suggestions if suggestions is not None else None,
+        'NHTSA YEAR': decoded_column(decoded_rows, 'Model Year'),
+        'NHTSA MAKE': decoded_column(decoded_rows, 'Make'),
+        'NHTSA MODEL': decoded_column(decoded_rows, 'Model'),
+        'YEAR': vin_data['YEAR'],
+        'MAKE': vin_data['MAKE'],
+        'MODEL': vin_data['MODEL'],
+        'FUEL': decoded_column(decoded_rows, 'Fuel Type - Primary'),
+        'COUNTRY': 'US',
+        'VEHICLE TYPE': decoded_column(decoded_rows, 'Vehicle Type'),
+        'ERROR CODE': [(vin_error or NO_INFORMATION_TEXT) if decoded_values is None
+                       else decoded_values.get('Error Text', 'N/A') for decoded_values, vin_error in zip(decoded_rows, row_errors)]
+    }, dtype = object)
+    
+    #create valid_vins dataframe that will be fed into CAN compatability check, exclude trailers, lifts
+    #and invalid VINs, exclude all rows where primary fuel type is N/A, Error or None, such results indicate
+    #valid vehicles require an energy source, only the columns in the CAN compatability format are kept and
+    #duplicate VINs are removed from the CAN compatability check document, including VINs of earlier chunks
+    valid_vins = results.loc[~results.FUEL.isin(['Not Applicable', 'Error', None]),
+                             ['VRN', 'VIN', 'YEAR', 'MAKE', 'MODEL', 'FUEL', 'COUNTRY']].drop_duplicates(subset = ['VIN'])
+    if seen is not None:
+        valid_vins = valid_vins[~valid_vins['VIN'].isin(seen)]
+    
+    #flag rows relating to trailers and lifts using the model and VRN recorded in the MCF deployment template
+    model_trailer = results['MODEL'].str.contains('trailer', case = False, regex = False)
+    model_lift = results['MODEL'].str.contains('lift', case = False, regex = False)
+    vrn_trailer = results['VRN'].str.contains('trailer', case = False, regex = False)
+    vrn_lift = results['VRN'].str.contains('lift', case = False, regex = False)
+    
+    #flag VINs seen on an earlier row, the first occurrence of a VIN is not a duplicate
+    duplicate = results['VIN'].duplicated()
+    if seen is not None:
+        duplicate |= results['VIN'].isin(seen)
+    
+    #determine if a manual check of a given vehicle vin is necessary, the first matching condition decides:
+    #the first occurrence of a VIN in the CAN dataframe, trailers, lifts and example VINs need no manual check,
+    #duplicate VINs and every other VIN need a manual check
+    check_list = np.select([results['VIN'].isin(valid_vins['VIN']) & ~duplicate,
+                            results['VEHICLE TYPE'] == 'TRAILER',
+                            model_trailer | vrn_trailer,
+                            model_lift | vrn_lift,
+                            results['VIN'].str.contains('example', case = False, regex = False),
+                            duplicate],
+                           ['NO', 'NO', 'NO', 'NO', 'NO', 'YES: Duplicate Vin'], 'YES')
+    #VINs with a suggested correction were entered wrong, the check of these VINs is to confirm the suggestion
+    check_list = np.where(results['VIN SUGGESTION'].notna() & ~duplicate, 'YES: Confirm VIN Suggestion', check_list)
+    
+    #update vehicle type to indicate the vehicle is a trailer, lift or type is unkown where necessary
+    unknown_type = results['VEHICLE TYPE'].isna() | (results['VEHICLE TYPE'] == 'Error')
+    results.loc[unknown_type, 'VEHICLE TYPE'] = np.select([model_trailer[unknown_type], model_lift[unknown_type]],
+                                                          ['TRAILER', 'LIFT'], 'UNKNOWN')
+
+    #create results column indicating that somone needs to manually check a vehicle's VIN info using check_list
+    results.insert(len(results.columns) - 1, 'MANUAL CHECK NEEDED', check_list)
+    
+    if seen is not None:
+        seen.update(results['VIN'])
+    return results, valid_vins, pending
+
+#columns of the processed VINs sheet holding the decoded values of each row and the variable they were decoded from
+BASELINE_FIELDS = {'NHTSA YEAR': 'Model Year', 'NHTSA MAKE': 'Make', 'NHTSA MODEL': 'Model',
+                   'FUEL': 'Fuel Type - Primary', 'VEHICLE TYPE': 'Vehicle Type', 'ERROR CODE': 'Error Text'}
+
+#read the decoded values of every row of a previous _processed.xlsx file, the baseline can be a file path or a
+#file-like object, returns a dictionary of (VRN, VIN) to the decoded values the row was built from, None marks a VIN
+#with no information found, rows with an invalid VIN or not decoded because processing stopped early are left out,
+#and the set of (VRN, VIN) of trailers whose vehicle type may have been filled from a model naming a trailer
+def read_baseline(baseline):
+    wb = openpyxl.load_workbook(BytesIO(read_upload(baseline)), read_only = True, data_only = True)
+    try:
+        ws = wb['Processed VINs'] if 'Processed VINs' in wb.sheetnames else wb.worksheets[0]
+        rows = ws.iter_rows(values_only = True)
+        header = list(next(rows, ()))
+        missing = [column for column in ['VRN', 'VIN', 'MODEL'] + list(BASELINE_FIELDS) if column not in header]
+        if missing:
+            raise ValueError('The previous processed file is missing the {} columns, please upload the _processed.xlsx '
+                             'file produced by this application'.format(', '.join(missing)))
+        positions = {column: header.index(column) for column in header if column is not None}
+        decoded = {}
+        trailers = set()
+        for row in rows:
+            values = {column: row[position] if position < len(row) else None for column, position in positions.items()}
+            if values['VIN'] is None:
+                continue
+            #VRNs are written as text, empty VRNs are written as empty cells
+            key = ('' if values['VRN'] is None else str(values['VRN']), str(values['VIN']))
+            #rows with no information found have every decoded column set to 'Error', only the error code tells
+            #VINs NHTSA found no information for apart from invalid VINs and VINs that were not decoded
+            if all(values[column] == 'Error' for column in ['NHTSA YEAR', 'NHTSA MAKE', 'NHTSA MODEL', 'FUEL']):
+                if values['ERROR CODE'] == NO_INFORMATION_TEXT:
+                    decoded[key] = None
+                continue
+            decoded_values = {name: values[column] for column, name in BASELINE_FIELDS.items()}
+            #vehicle types NHTSA did not return were filled with 'UNKNOWN' or 'LIFT' from the model, they are
+            #filled again from the model of the new template, a 'TRAILER' may be NHTSA's vehicle type or filled from
+            #a model naming a trailer, both give the same results while the model still names a trailer
+            if decoded_values['Vehicle Type'] in ('UNKNOWN', 'LIFT'):
+                decoded_values['Vehicle Type'] = None
+            elif decoded_values['Vehicle Type'] == 'TRAILER' and 'trailer' in str(values['MODEL'] or '').lower():
+                trailers.add(key)
+            decoded[key] = decoded_values
+        return decoded, trailers
+    finally:
+        wb.close()
+
+#return the decoded values carried forward from a baseline read by read_baseline for the rows of vin_data with the
+#same VRN and VIN as a row of the baseline, returns a dictionary of cache key to decoded values, new and changed
+#rows are left out so only they are decoded, trailers are only carried forward while every row of their VIN still
+#has a model naming a trailer
+def carried_forward(vin_data, normalized, baseline):
+    decoded, trailers = baseline
+    not_trailers = {cache_key(value) for value, model in zip(normalized['VIN'], vin_data['MODEL']) if 'trailer' not in model.lower()}
+    carried = {}
+    for vrn, value, vin_error in zip(vin_data['VRN'], normalized['VIN'], normalized['VIN ERROR']):
+        if vin_error is None and (vrn, value) in decoded and not ((vrn, value) in trailers and cache_key(value) in not_trailers):
+            carried[cache_key(value)] = decoded[(vrn, value)]
+    rows = [cache_key(value) in carried for value, vin_error in zip(normalized['VIN'], normalized['VIN ERROR']) if vin_error is None]
+    vin_metrics.count('baseline_rows', sum(rows))
+    return carried
+
+#read and decode the vehicles of an upload, returns the results dataframe holding every VIN, the valid_vins
+#dataframe in the format of the CAN compatability check and the number of rows that were not decoded because
+#processing stopped early, given the previous _processed.xlsx file of the template as baseline only rows that are
+#new or changed since are decoded, the decoded values of unchanged rows are carried forward from the baseline,
+#corrections are suggested for VINs that could not be decoded unless suggest is False, NHTSA requests are sent at
+#the given priority, by default uploads needing at most SMALL_UPLOAD_VINS VINs are interactive and larger ones bulk
+def decode_upload(upload, batch = True, max_workers = MAX_WORKERS, use_cache = True, use_offline = True, progress = None,
+                  resume = True, baseline = None, suggest = True, priority = None):
+    #read the vehicles from the upload in a single pass, the upload can be a file path or an in-memory file, excel
+    #files with more than 1 sheet are read from the sheet named 'Vehicle & Asset List' as this is the standard naming
+    #convention, only the columns needed are written into dataframe named 'raw_vin_data' under standardized names,
+    #the time spent in each stage is recorded in the current run
+    timer = vin_metrics.timer()
+    data = read_upload(upload)
+    raw_vin_data = read_template(data)
+    timer.lap('ingest')
+    
+    vin_data = vehicle_rows(raw_vin_data)
+    vin_metrics.count('rows', len(vin_data))
+    
+    #correct common data entry errors for the whole VIN column at once and flag VINs that cannot be valid,
+    #the normalized dataframe lines up with the rows of the vin_data dataframe
+    normalized = normalize_vins(vin_data['VIN'])
+    timer.lap('normalize')
+    
+    #only VINs that can be valid and were not decoded for the baseline are sent to NHTSA
+    carried = carried_forward(vin_data, normalized, read_baseline(baseline)) if baseline is not None else {}
+    lookup_values = [value for value in normalized.loc[normalized['VIN ERROR'].isna(), 'VIN'] if cache_key(value) not in carried]
+    
+    #query the NHTSA VIN database using the corrected VINs to collect info on vehicle year, make, model, fuel,
+    #and vehicle type, VINs decoded by a previous upload are read from the VIN cache and VINs the local vPIC extract
+    #can decode are decoded offline instead, decoded VINs are checkpointed so an interrupted upload resumes where
+    #it stopped, if processing stops early (time out or any other error) the VINs decoded so far are still used
+    checkpoint = checkpoint_path(data) if resume else None
+    if priority is None:
+        priority = INTERACTIVE if len(set(map(cache_key, lookup_values))) <= SMALL_UPLOAD_VINS else BULK
+    lookup_options = {'batch': batch, 'max_workers': max_workers, 'cache': get_cache() if use_cache else None,
+                      'offline': get_offline_decoder() if use_offline else None, 'priority': priority}
+    decoded, error = decode_in_chunks(lookup_values, checkpoint = checkpoint, progress = progress, **lookup_options)
+    #the upload is complete, its checkpoint is no longer needed
+    if error is None and checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    decoded.update(carried)
+    
+    #suggest corrections for the VINs that could not be decoded, their candidates are verified with NHTSA together
+    suggestions = suggest_corrections(vin_data, normalized, decoded, **lookup_options) if suggest else None
+    timer.lap('decode')
+    
+    #the manual checks, duplicate VINs and CAN csv are worked out again over every row, carried forward or not
+    results, valid_vins, pending = build_results(vin_data, normalized, decoded, suggestions = suggestions)
+    timer.lap('post_process')
+    
+    return results, valid_vins, pending
+
+#produce the output files from the decoded results, returns the contents of the processed excel and CAN csv files
+def output_files(results, valid_vins):
+    #valid_vins should be written to a CSV that is uploaded to SalesForce CAN compatability check, the CSV is
+    #produced in memory
+    can_data = valid_vins.to_csv(index = False).encode('utf-8')
+    
+    #write results dataframe to an in-memory Excel file, this will be the inclusive excel file with all VINS,
+    #error codes, manual checks and vehicle types for employee reference
+    processed_data = processed_workbook(results)
+    return processed_data, can_data
+
+#decode an upload and produce its output files, returns the results dataframe, the contents of the processed excel
+#and CAN csv files and the number of rows that were not decoded because processing stopped early, options are passed
+#to decode_upload, given a fleet store (see vin_store) the results are also appended to the store under the name of
+#the uploaded file, shared by confirm_vin and the command line interface
+def decode_outputs(upload, store = None, name = None, **options):
+    data = read_upload(upload)
+    results, valid_vins, pending = decode_upload(data, **options)
+    timer = vin_metrics.timer()
+    processed_data, can_data = output_files(results, valid_vins)
+    timer.lap('excel_write')
+    if store is not None:
+        store.append(results, data, name)
+        timer.lap('store_write')
+    return results, processed_data, can_data, pending
+
+#process an upload, returns the fleet summary, the contents of the processed excel and CAN csv files and the
+#number of rows that were not decoded because processing stopped early, options are passed to decode_outputs, the
+#run is recorded by the instrumentation layer
+def confirm_vin(upload, **options):
+    with vin_metrics.record():
+        results, processed_data, can_data, pending = decode_outputs(upload, **options)
+        timer = vin_metrics.timer()
+        known_vehicles, unknown_vehicles = grouped_vehicles(results)
+        timer.lap('summary')
+    
+    #save and return number of distinct vehicles, the contents of the processed excel and can csv files to export
+    #and the number of rows that were not decoded because processing stopped early
+    return known_vehicles, unknown_vehicles, processed_data, can_data, pending
+
+#process an upload in streaming mode for very large fleets, the template is read, decoded and written chunk_rows
+#rows at a time so memory use does not grow with the fleet, the processed excel file is written to processed_path
+#and the CAN csv file to can_path with the same contents confirm_vin produces, returns the fleet summary counts,
+#the unconfirmed vehicles (see summarize_fleet) and the number of rows that were not decoded because processing
+#stopped early, decoded VINs are not checkpointed, the VIN cache keeps them so a stopped run is not decoded again,
+#a baseline, suggest and a fleet store are used as in decode_upload and confirm_vin, the results are written to
+#the store chunk by chunk, streamed uploads are large so their NHTSA requests are bulk unless told otherwise
+def stream_upload(upload, processed_path, can_path, batch = True, max_workers = MAX_WORKERS, use_cache = True,
+                  use_offline = True, chunk_rows = STREAM_CHUNK_ROWS, baseline = None, suggest = True, store = None,
+                  name = None, priority = BULK):
+    lookup_options = {'batch': batch, 'max_workers': max_workers, 'cache': get_cache() if use_cache else None,
+                      'offline': get_offline_decoder() if use_offline else None, 'priority': priority}
+    #VINs of earlier chunks, used to flag duplicate VINs and keep them out of the CAN csv
+    seen = set()
+    counts = Counter()
+    unconfirmed = []
+    pending = 0
+    error = None
+    widths = None
+    columns = None
+    data = read_upload(upload)
+    with vin_metrics.record(), tempfile.TemporaryFile('w+', encoding = 'utf-8') as rows, \
+            open(can_path, 'w', newline = '', encoding = 'utf-8') as can_file, \
+            store.writer(data, name) if store is not None else nullcontext() as store_writer:
+        timer = vin_metrics.timer()
+        #the baseline is read before the processed file is written as it may be the file being replaced
+        baseline = read_baseline(baseline) if baseline is not None else None
+        for chunk_number, raw_vin_data in enumerate(template_chunks(data, chunk_rows)):
+            timer.lap('ingest')
+            vin_data = vehicle_rows(raw_vin_data)
+            vin_metrics.count('rows', len(vin_data))
+            normalized = normalize_vins(vin_data['VIN'])
+            timer.lap('normalize')
+            
+            #once processing stops early the rows of the remaining chunks are not decoded
+            carried = carried_forward(vin_data, normalized, baseline) if baseline is not None else {}
+            lookup_values = [value for value in normalized.loc[normalized['VIN ERROR'].isna(), 'VIN'] if cache_key(value) not in carried]
+            decoded = {}
+            if error is None:
+                decoded, error = decode_in_chunks(lookup_values, **lookup_options)
+            decoded.update(carried)
+            suggestions = suggest_corrections(vin_data, normalized, decoded, **lookup_options) if suggest else None
+            timer.lap('decode')
+            
+            results, valid_vins, chunk_pending = build_results(vin_data, normalized, decoded, seen, suggestions)
+            pending += chunk_pending
+            timer.lap('post_process')
+            
+            #the CAN csv is written as chunks are processed, the processed rows are kept in a temporary file until
+            #the width of every column is known as the widths are written before the rows
+            valid_vins.to_csv(can_file, index = False, header = chunk_number == 0)
+            widths = column_widths(results, widths)
+            columns = results.columns
+            for row in result_rows(results):
+                rows.write(json.dumps(row) + '\n')
+            timer.lap('excel_write')
+            if store_writer is not None:
+                store_writer.write(results)
+                timer.lap('store_write')
+            
+            chunk_counts, chunk_unconfirmed = summarize_fleet(results)
+            counts.update(chunk_counts.to_dict())
+            unconfirmed.append(chunk_unconfirmed)
+            timer.lap('summary')
+        
+        rows.seek(0)
+        write_processed_workbook(processed_path, columns, widths, (tuple(json.loads(line)) for line in rows))
+        timer.lap('excel_write')
+    return pd.Series(counts, dtype = 'int64'), pd.concat(unconfirmed, ignore_index = True), pending
+
+#version of the processing pipeline, bump whenever a change alters the output files or fleet summary so cached
+#results produced by an older version are not reused
+PIPELINE_VERSION = '2'
+
+#maximum memory used by cached results, the least recently used results are evicted once the cache is full
+RESULT_CACHE_BYTES = 256 * 1024 * 1024
+
+#in-memory cache of processed uploads keyed by a hash of the uploaded bytes and the pipeline version, holds the
+#fleet summary, processed excel and CAN csv files returned by confirm_vin
+class ResultCache:
+    def __init__(self, max_bytes = RESULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        #results in order of use, least recently used first, each entry holds the result and its size in bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    #return the cache key of the contents of an upload and of the baseline it was processed against
+    @staticmethod
+    def key(data, baseline = None):
+        return hashlib.sha256(PIPELINE_VERSION.encode() + b'\0' + data + (b'\0' + baseline if baseline is not None else b'')).hexdigest()
+
+    #return the cached result of a key or None if it is not cached
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    #cache a result, results larger than the whole cache are not cached
+    def put(self, key, result):
+        size = sum(len(value) for value in result if isinstance(value, (str, bytes)))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (result, size)
+            self.size += size
+            #evict the least recently used results until the cache fits in max_bytes
+            while self.size > self.max_bytes:
+                self.size -= self._entries.popitem(last = False)[1][1]
+
+#process an upload, returning the cached result if the same file was processed before, only complete results are
+#cached so an upload that stopped early resumes from its checkpoint when it is processed again, an upload processed
+#against a baseline is cached apart from the same upload processed in full
+def process_upload(upload, result_cache = None, baseline = None, **options):
+    with vin_metrics.record():
+        data = read_upload(upload)
+        baseline = read_upload(baseline) if baseline is not None else None
+        key = ResultCache.key(data, baseline)
+        result = result_cache.get(key) if result_cache is not None else None
+        if result is None:
+            result = confirm_vin(data, baseline = baseline, **options)
+            if result_cache is not None and result[4] == 0:
+                result_cache.put(key, result)
+        else:
+            vin_metrics.count('result_cache_hits')
+    return result
+
+#the result cache shared by every upload in this process, created on first use
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+#return the shared result cache, creating it on first use
+def get_result_cache():
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache()
+        return _result_cache
@@ -0,0 +1,155 @@
+#historical store of processed fleets, the results of every run are appended to a Parquet dataset partitioned by
+#date and upload so aggregates over many fleets ('which customers run Freightliner Cascadias') are answered by
+#reading only the columns and partitions a query needs instead of opening every _processed.xlsx file
+#
+#the store is kept next to the application, set AUTOVIN_STORE to keep it somewhere else
+
+#import necessary packages
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+#location of the fleet store, one directory per date and upload holding the results of that upload
+STORE_PATH = os.environ.get('AUTOVIN_STORE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fleet_store'))
+
+#partition columns, the date the upload was processed and a hash of the uploaded bytes, read from the directory names
+PARTITIONING = ds.partitioning(pa.schema([('DATE', pa.string()), ('UPLOAD', pa.string())]), flavor = 'hive')
+
+#columns added to the columns of the processed VINs sheet, the name of the uploaded file and when it was processed
+FILE_COLUMNS = ['FILE', 'PROCESSED']
+
+#columns the app filters and groups by
+QUERY_COLUMNS = ['NHTSA MAKE', 'NHTSA MODEL', 'VEHICLE TYPE', 'MANUAL CHECK NEEDED']
+
+#return the partition key of an upload from its contents
+def upload_key(data):
+    return hashlib.sha256(data).hexdigest()[:16]
+
+#convert a chunk of results to a table of the store, every column is stored as text so the schema does not depend
+#on the values of one upload, empty values are stored as nulls
+def results_table(results, name, processed):
+    columns = {column: [None if pd.isna(value) else str(value) for value in results[column]] for column in results.columns}
+    columns['FILE'] = [name] * len(results)
+    columns['PROCESSED'] = [processed] * len(results)
+    return pa.table({column: pa.array(values, type = pa.string()) for column, values in columns.items()})
+
+#writes the results of one upload to its partition of the store chunk by chunk, the results are written to a
+#temporary file that replaces the partition once every chunk is written, so a partition only ever holds the
+#complete results of a single run and processing the same upload again on the same day replaces its results
+class StoreWriter:
+    def __init__(self, partition, name):
+        self.partition = partition
+        self.name = name
+        self.processed = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self._path = os.path.join(partition, f'.{uuid.uuid4().hex}.parquet.tmp')
+        self._writer = None
+
+    def write(self, results):
+        table = results_table(results, self.name, self.processed)
+        if self._writer is None:
+            os.makedirs(self.partition, exist_ok = True)
+            self._writer = pq.ParquetWriter(self._path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        os.replace(self._path, os.path.join(self.partition, 'results.parquet'))
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            os.remove(self._path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+#store of the results of every processed upload, partitioned by the date of the run and a hash of the upload
+class FleetStore:
+    def __init__(self, path = STORE_PATH):
+        self.path = path
+
+    #return a writer of the results of an upload, data is the uploaded bytes and name the name of the uploaded file
+    def writer(self, data, name):
+        partition = os.path.join(self.path, 'DATE=' + time.strftime('%Y-%m-%d'), 'UPLOAD=' + upload_key(data))
+        return StoreWriter(partition, name)
+
+    #append the results dataframe of an upload to the store
+    def append(self, results, data, name):
+        with self.writer(data, name) as writer:
+            writer.write(results)
+
+    #return the result files of the store, by default only the latest run of each upload is returned so an upload
+    #processed on several days is only counted once
+    def files(self, latest = True):
+        if not os.path.isdir(self.path):
+            return []
+        runs = {}
+        for date in sorted(os.listdir(self.path)):
+            if not date.startswith('DATE='):
+                continue
+            for upload in os.listdir(os.path.join(self.path, date)):
+                path = os.path.join(self.path, date, upload, 'results.parquet')
+                if upload.startswith('UPLOAD=') and os.path.exists(path):
+                    runs.setdefault(upload, []).append(path)
+        #dates are listed oldest first, the last run of an upload is its latest
+        if latest:
+            return sorted(paths[-1] for paths in runs.values())
+        return sorted(path for paths in runs.values() for path in paths)
+
+    #read the rows of the store matching every filter, filters map a column to a value or a list of values, only
+    #the columns asked for are read (every column by default), returns a dataframe
+    def query(self, columns = None, filters = None, latest = True):
+        files = self.files(latest)
+        if not files:
+            return pd.DataFrame(columns = columns or [])
+        dataset = ds.dataset(files, format = 'parquet', partitioning = PARTITIONING, partition_base_dir = self.path)
+        expression = None
+        for column, values in (filters or {}).items():
+            values = [values] if isinstance(values, str) else list(values)
+            condition = ds.field(column).isin(values)
+            expression = condition if expression is None else expression & condition
+        return dataset.to_table(columns = columns, filter = expression).to_pandas()
+
+    #count the rows of the store matching every filter in each group of the group_by columns, returns a dataframe
+    #holding the group columns, the number of vehicles and the number of uploads they were found in, largest first
+    def aggregate(self, group_by, filters = None, latest = True):
+        group_by = list(group_by)
+        frame = self.query(columns = group_by + ['UPLOAD'], filters = filters, latest = latest)
+        if frame.empty:
+            return pd.DataFrame(columns = group_by + ['VEHICLES', 'UPLOADS'])
+        #empty values are grouped together instead of being dropped
+        frame[group_by] = frame[group_by].fillna('')
+        counts = frame.groupby(group_by).agg(VEHICLES = ('UPLOAD', 'size'), UPLOADS = ('UPLOAD', 'nunique'))
+        return counts.reset_index().sort_values('VEHICLES', ascending = False, ignore_index = True)
+
+    #return the distinct values of a column, used to offer the values a query can filter on
+    def values(self, column, latest = True):
+        frame = self.query(columns = [column], latest = latest)
+        return sorted(frame[column].dropna().unique().tolist()) if not frame.empty else []
+
+#the fleet store shared by every upload in this process, created on first use
+_fleet_store = None
+_fleet_store_lock = threading.Lock()
+
+#return the shared fleet store, creating it on first use
+def get_fleet_store():
+    global _fleet_store
+    with _fleet_store_lock:
+        if _fleet_store is None:
+            _fleet_store = FleetStore()
+        return _fleet_store